@@ -58,6 +58,8 @@ import os
 import logging
 import sys
 import shutil
+from pathlib import Path
+from availability import Availability
 #%%
 #When the script starts
 scriptstart=dt.datetime.now()
@@ -182,7 +184,9 @@ param = "207.210/209.210"  #
 times = ["00:00:00"]  #   model initialization time
 step = "0/12"    # eg 0/6/12/18
 format_ = "netcdf"   # or grib
+check_availability = True  #ask MARS (cached, see availability.py) before submitting, skips dates not uploaded yet
 #%%
+avail = Availability(server, Path(base_dir), logger) if check_availability else None
 empty_folders = []  # store folders with no data
 downloaded_folders = []  # store successful folders
 
@@ -214,23 +218,28 @@ while date <= today:
             day_has_data = True
             continue
 
+        request = {
+            "class": classs,
+            "type": type_,
+            "stream": stream,
+            "expver": expver,
+            "levtype": levtype,
+            "param": param,
+            "date": rundate,
+            "time": time,
+            "step": step,
+            "area": area,
+            "grid": grid,
+            "format": format_
+        }
+        # Skip if MARS does not have it yet (no queue slot wasted)
+        if avail is not None and avail.check(request) is False:
+            logger.info(f"Not in MARS catalogue yet: {outfile}")
+            continue
+
         # Try to download
         try:
             logger.info(f" Downloading {outfile} ...")
-            request = {
-                "class": classs,
-                "type": type_,
-                "stream": stream,
-                "expver": expver,
-                "levtype": levtype,
-                "param": param,
-                "date": rundate,
-                "time": time,
-                "step": step,
-                "area": area,
-                "grid": grid,
-                "format": format_
-            }
             server.execute(request, target=outpath)
             logger.info(f" Download completed: {outpath}")
             day_has_data = True
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import datetime as dt
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from topup import format_steps, missing_steps
+
+# ============================================================
+# Archive index (one row per downloaded window file)
+# ============================================================
+# Lives at DOWNLOAD_ROOT/INDEX_NAME and is shared by all profiles
+# (profile = "REGNAME/EXPVER/TYPE/LEVTYPE", i.e. build_base_dir() relative
+# to the root). Files are registered at ingest; tools that prune or query the
+# archive go through the index instead of walking the tree.
+# A row's size counts everything stored for its window: the data in its
+# current tier, the summary and the derived grids. Station tables and other
+# products that are not per window are added by disk_usage().
+#
+# Usage:
+#   python archive_index.py rebuild [ROOT]   # one-off bootstrap from the tree
+
+DOWNLOAD_ROOT = Path("/home/agkiokas/MARS/data/")
+INDEX_NAME = "archive_index.sqlite"
+
+# Storage tiers, in the order retention moves files through them
+TIERS = ["full", "compressed", "summary", "deleted"]
+
+SUMMARY_SUFFIX = ".summary.npz"     # daily_summaries.py
+DERIVED_DIR_GLOB = "grid_*"         # regrid.py, next to the window
+SHARED_DIRS = ["station_series"]    # stations.py, relative to the root
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path       TEXT PRIMARY KEY,   -- relative to DOWNLOAD_ROOT, always the .nc name
+    profile    TEXT NOT NULL,
+    run_date   TEXT NOT NULL,      -- YYYYMMDD
+    valid_date TEXT NOT NULL,      -- YYYYMMDD
+    size       INTEGER NOT NULL,   -- bytes currently on disk for this window (see window_files)
+    tier       TEXT NOT NULL DEFAULT 'full',
+    added      REAL NOT NULL,
+    missing_steps TEXT             -- "15/18/21" for partial windows (see topup.py), else NULL
+);
+CREATE INDEX IF NOT EXISTS files_profile_run ON files(profile, run_date);
+CREATE INDEX IF NOT EXISTS files_tier ON files(tier);
+"""
+
+
+def index_path(root: Path) -> Path:
+    return root / INDEX_NAME
+
+
+def open_index(root: Path) -> sqlite3.Connection:
+    root.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(index_path(root)), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    if "missing_steps" not in {row[1] for row in conn.execute("PRAGMA table_info(files)")}:
+        conn.execute("ALTER TABLE files ADD COLUMN missing_steps TEXT")
+    return conn
+
+
+def _dmy_to_ymd(s: str) -> str:
+    return dt.datetime.strptime(s, "%d_%m_%Y").strftime("%Y%m%d")
+
+
+def parse_window_path(root: Path, path: Path) -> Optional[tuple[str, str, str]]:
+    """
+    <root>/<profile...>/<YYYYMMDD>/<HH_MM_SS>/<DD_MM_YYYY-DD_MM_YYYY>.nc
+    -> (profile, run_date, valid_date), or None if the path does not match.
+    """
+    rel = path.relative_to(root)
+    parts = rel.parts
+    if len(parts) < 4:
+        return None
+    run_date = parts[-3]
+    if len(run_date) != 8 or not run_date.isdigit():
+        return None
+    label = path.name.split(".", 1)[0]
+    try:
+        valid_date = _dmy_to_ymd(label.split("-")[-1])
+    except ValueError:
+        return None
+    return "/".join(parts[:-3]), run_date, valid_date
+
+
+def window_files(nc: Path) -> List[Path]:
+    """Files on disk belonging to the window `nc` (the .nc name), whatever its tier."""
+    files = [nc, nc.with_name(nc.name + ".gz"), nc.with_name(nc.stem + SUMMARY_SUFFIX)]
+    files += sorted(nc.parent.glob(f"{DERIVED_DIR_GLOB}/{nc.name}"))
+    return [p for p in files if p.is_file()]
+
+
+def window_bytes(nc: Path) -> int:
+    return sum(p.stat().st_size for p in window_files(nc))
+
+
+def register(conn: sqlite3.Connection, root: Path, path: Path,
+             tier: str = "full", commit: bool = True) -> bool:
+    parsed = parse_window_path(root, path)
+    if parsed is None:
+        return False
+    profile, run_date, valid_date = parsed
+    nc = path if path.suffix == ".nc" else path.with_name(path.name.split(".", 1)[0] + ".nc")
+    missing = format_steps(missing_steps(path)) if tier == "full" else ""
+    conn.execute(
+        "INSERT OR REPLACE INTO files(path, profile, run_date, valid_date, size, tier, added, missing_steps) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (str(nc.relative_to(root)), profile, run_date, valid_date,
+         window_bytes(nc), tier, time.time(), missing or None),
+    )
+    if commit:
+        conn.commit()
+    return True
+
+
+def register_file(root: Path, path: Path) -> bool:
+    """Single-shot registration used at ingest."""
+    conn = open_index(root)
+    try:
+        return register(conn, root, path)
+    finally:
+        conn.close()
+
+
+def partial_windows(root: Path, profile: str) -> List[Tuple[str, str]]:
+    """(run_date, valid_date) of the profile's windows still missing steps."""
+    conn = open_index(root)
+    try:
+        rows = conn.execute(
+            "SELECT run_date, valid_date FROM files WHERE profile = ? AND tier = 'full' "
+            "AND missing_steps IS NOT NULL ORDER BY run_date DESC, valid_date",
+            (profile,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [(r["run_date"], r["valid_date"]) for r in rows]
+
+
+def retired_windows(root: Path, profile: str) -> Dict[str, str]:
+    """Index path -> tier of the profile's windows retention has moved past 'full'."""
+    conn = open_index(root)
+    try:
+        rows = conn.execute(
+            "SELECT path, tier FROM files WHERE profile = ? AND tier != 'full'", (profile,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {r["path"]: r["tier"] for r in rows}
+
+
+def total_size(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE tier != 'deleted'").fetchone()
+    return int(row[0])
+
+
+def _tree_bytes(d: Path) -> int:
+    return sum(p.stat().st_size for p in d.rglob("*") if p.is_file()) if d.is_dir() else 0
+
+
+def disk_usage(conn: sqlite3.Connection, root: Path) -> int:
+    """Indexed windows plus the shared (not per window) products under the root."""
+    used = total_size(conn)
+    used += sum(_tree_bytes(root / d) for d in SHARED_DIRS)
+    return used
+
+
+def rebuild(root: Path) -> int:
+    conn = open_index(root)
+    n = 0
+    try:
+        for p in root.rglob("*.nc"):
+            if p.is_file() and register(conn, root, p, commit=False):
+                n += 1
+        # the key stays on the .nc name, whatever tier the data is in
+        for p in root.rglob("*.nc.gz"):
+            nc = p.with_suffix("")
+            if p.is_file() and not nc.exists() and register(conn, root, p, tier="compressed", commit=False):
+                n += 1
+        for p in root.rglob("*" + SUMMARY_SUFFIX):
+            nc = p.with_name(p.name[:-len(SUMMARY_SUFFIX)] + ".nc")
+            if (p.is_file() and not nc.exists() and not nc.with_name(nc.name + ".gz").exists()
+                    and register(conn, root, p, tier="summary", commit=False)):
+                n += 1
+        conn.commit()
+    finally:
+        conn.close()
+    return n
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    if not args or args[0] != "rebuild":
+        print("usage: archive_index.py rebuild [ROOT]", file=sys.stderr)
+        return 1
+    root = Path(args[1]) if len(args) > 1 else DOWNLOAD_ROOT
+    print(f"Indexed {rebuild(root)} files under {root}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
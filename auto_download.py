@@ -6,12 +6,25 @@ import datetime as dt
 import logging
 import os
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Dict, Tuple, List, Optional
 from ecmwfapi import *
 from ecmwfapi import ECMWFDataServer,ECMWFService
 import math
+from functools import partial
+from archive_index import partial_windows, register_file, retired_windows
+from publisher import publish_change
+from regrid import check_aligned, derive_all
+from availability import Availability
+from daily_summaries import summarise_window
+from pipeline import Item, Pipeline, Stage, build_stages, register_stage
+from scheduler import BACKFILL, FRESH, Job, JobQueue
+from stations import append_window, load_stations
+from throttle import BUCKET_NAME, AIMDController, RequestTimer, TokenBucket
+from topup import TOPUP_SUFFIX, available_prefix, format_steps, mark_partial, merge_steps, missing_steps, parse_steps
 #KEYS TO ACCESS THE DATA
 os.environ["ECMWF_API_URL"] = "https://api.ecmwf.int/v1"
 os.environ["ECMWF_API_KEY"] = "fe1dcb573a3baa56c7ac659aa5f35508"
@@ -48,6 +61,33 @@ KEEP_DAY_INDICES = [0, 2, 4]  # keep day0, day2, day4 (skip day1 and day3)
 RUN_DATE_YYYYMMDD: Optional[str] = None   # e.g. "20260114" (if set, overrides offset)
 RUN_DATE_OFFSET_DAYS = 3   #HOW MANY DAYS BACK IN TIME YOU WANT TO DOWNLOAD?0 MEANS TODAY
 
+# Ask MARS what exists before submitting (see availability.py)
+CHECK_AVAILABILITY = True
+# If RUN_DATE_YYYYMMDD is None: use the newest run date whose last kept window
+# is fully in MARS, searching this many days back (offset above is the fallback).
+# With PARTIAL_DOWNLOADS, the newest run date whose first step is in MARS is
+# used instead, and that complete run date is queued as backfill.
+AUTO_RUN_DATE = True
+RUN_DATE_SEARCH_DAYS = 7
+
+# Scheduling (see scheduler.py): the run date above is always served first,
+# day 0 before the later windows. Older run dates are caught up afterwards.
+BACKFILL_DAYS = 0      # also fill missing windows of this many earlier run dates
+REPAIR_ATTEMPTS = 1    # re-queue a failed window this many times (lowest priority)
+
+# If only the first steps of a window are in MARS yet, download those and mark
+# the file partial; later runs fetch just the missing steps and append them
+# in place (see topup.py). Needs CHECK_AVAILABILITY.
+PARTIAL_DOWNLOADS = True
+
+# Concurrent MARS requests (see throttle.py): the number in flight is adapted
+# (AIMD) from the observed ECMWF queue times and transfer rates.
+MIN_INFLIGHT = 1
+MAX_INFLIGHT = 2      # the ECMWF Web API runs 2 requests per user at once
+# Optional cap on the average download rate, shared with the other download
+# scripts writing under DOWNLOAD_ROOT on this host. None = no cap.
+BANDWIDTH_CAP_MBPS: Optional[float] = None   # MB/s
+
 # Logging
 LOG_NAME = "CAMS_mars_fc.log"
 
@@ -57,6 +97,30 @@ ABS_MIN_BYTES = 8_000          # raise if you expect bigger domains
 REL_MIN_FACTOR = 0.10          # fail if file is <10% of rough expected size (when expected is large)
 EXPECTED_MIN_TRIGGER = 50_000  # only apply relative check above this expected size
 
+# Coarser grids derived locally from the GRID download (see regrid.py).
+# GRID must be the finest grid; each entry must be a multiple of it.
+DERIVED_GRIDS: List[str] = []   # e.g. ["0.8/0.8", "1.2/1.2"]
+REGRID_METHOD = "conservative"  # or "bilinear"
+
+# Append every finished file to the change feed read by mirrors (see publisher.py)
+PUBLISH_CHANGES = True
+
+# Daily summary products (see daily_summaries.py), computed in a worker pool
+SUMMARISE_AT_INGEST = True
+
+# Station time series appended to station_series/ at ingest (see stations.py);
+# skipped when the station list does not exist
+EXTRACT_STATIONS = True
+STATIONS_CSV = DOWNLOAD_ROOT / "stations.csv"   # columns: id,lat,lon
+
+# Post-download processing runs in pipeline.py while the next request downloads:
+# verify -> extract -> summarise -> regrid -> index -> publish (as enabled
+# above; index after the products so the window's size includes them, publish
+# last so mirrors only hear of finished windows). Only verify failures stop a
+# file; they are re-queued as repairs. Extra stages registered with
+# pipeline.register_stage go at the end.
+EXTRA_STAGES: List[str] = []
+
 # ==========================================
 # Helpers
 # ============================================================
@@ -218,15 +282,21 @@ def _estimate_raw_bytes(area: str, grid: str, ntime: int, nparam: int) -> int:
     return max(0, nlat * nlon * ntime * nparam * 4)
 
 
-def mars_execute(server: ECMWFService, req: Dict[str, str], target: Path, ntime: int, logger: logging.Logger) -> None:
+def mars_download(server: ECMWFService, req: Dict[str, str], target: Path, logger: logging.Logger) -> float:
+    """Retrieve into '<target>.part'; returns the transfer time in seconds."""
     tmp = target.with_suffix(target.suffix + ".part")
     tmp.unlink(missing_ok=True)
 
     t0 = time.time()
     logger.info(f"Downloading -> {target.name}")
     server.execute(req, str(tmp))
-    dt_s = time.time() - t0
+    return time.time() - t0
 
+
+def finalize_download(target: Path, ntime: int, dt_s: float, logger: logging.Logger,
+                      missing: Optional[List[int]] = None) -> None:
+    """Check '<target>.part' and rename it into place (marked partial if steps are `missing`)."""
+    tmp = target.with_suffix(target.suffix + ".part")
     if not tmp.exists():
         raise RuntimeError("Download produced no file.")
 
@@ -250,9 +320,104 @@ def mars_execute(server: ECMWFService, req: Dict[str, str], target: Path, ntime:
             tmp.unlink(missing_ok=True)
             raise RuntimeError(f"File too small ({size} bytes). (ABS_MIN_BYTES={ABS_MIN_BYTES})")
 
+    if missing:
+        mark_partial(tmp, missing)
     tmp.replace(target)
     logger.info(f"Done: {target.name} | {size_mb:.2f} MB | {dt_s:.1f} s")
 
+
+def verify_item(item: Item, logger: logging.Logger) -> None:
+    """First pipeline stage: put a new window in place, or merge a top-up into it."""
+    meta = item.meta
+    piece = meta.get("piece")
+    if piece is None:
+        finalize_download(item.path, meta["ntime"], meta["seconds"], logger, missing=meta.get("missing"))
+        return
+    finalize_download(piece, meta["ntime"], meta["seconds"], logger)
+    left = merge_steps(item.path, piece, meta["steps"])
+    piece.unlink()
+    logger.info(f"Topped up: {item.name} + steps {format_steps(meta['steps'])}"
+                + (f", still missing {format_steps(left)}" if left else ", complete"))
+
+
+_local = threading.local()
+
+
+def thread_server() -> Tuple[ECMWFService, RequestTimer]:
+    """One MARS client per download thread, logging through its own timer."""
+    if not hasattr(_local, "server"):
+        _local.timer = RequestTimer()
+        _local.server = ECMWFService("mars", log=_local.timer.log)
+    return _local.server, _local.timer
+
+
+def fetch_window(ctl: AIMDController, pipe: Pipeline, req: Dict[str, str], out_path: Path,
+                 logger: logging.Logger, piece: Optional[Path] = None, **meta: object) -> None:
+    """
+    Runs in a download thread holding one controller slot. Top-ups download
+    into `piece` and are merged into `out_path` by the verify stage.
+    """
+    target = piece or out_path
+    server, timer = thread_server()
+    timer.start()
+    try:
+        dt_s = mars_download(server, req, target, logger)
+    except Exception:
+        ctl.release(timer.finish(0, ok=False))
+        raise
+    tmp = target.with_suffix(target.suffix + ".part")
+    ctl.release(timer.finish(tmp.stat().st_size if tmp.exists() else 0))
+    # checks, rename and post-processing overlap with the next downloads;
+    # blocks here if the pipeline is MAX_PENDING files behind
+    pipe.submit(Item(out_path, seconds=dt_s, piece=piece, **meta))
+
+
+# ---------- Pipeline stages ----------
+@register_stage("verify")
+def _verify_stage(logger: logging.Logger, **_) -> Stage:
+    return Stage("verify", lambda item: verify_item(item, logger), required=True)
+
+
+@register_stage("publish")
+def _publish_stage(**_) -> Stage:
+    return Stage("publish", lambda item: publish_change(DOWNLOAD_ROOT, item.path))
+
+
+@register_stage("index")
+def _index_stage(**_) -> Stage:
+    return Stage("index", lambda item: register_file(DOWNLOAD_ROOT, item.path))
+
+
+@register_stage("extract")
+def _extract_stage(**_) -> Stage:
+    stations = load_stations(STATIONS_CSV)
+    return Stage("extract", lambda item: append_window(DOWNLOAD_ROOT, item.path, stations))
+
+
+@register_stage("summarise")
+def _summarise_stage(**_) -> Stage:
+    return Stage("summarise", summarise_window, in_process=True)
+
+
+@register_stage("regrid")
+def _regrid_stage(derived: List[Tuple[float, float]], **_) -> Stage:
+    fn = partial(derive_all, grids=derived, method=REGRID_METHOD)
+    return Stage("regrid", fn, in_process=True)
+
+
+def pipeline_stage_names(derived: List[Tuple[float, float]]) -> List[str]:
+    names = ["verify"]
+    if EXTRACT_STATIONS and STATIONS_CSV.exists():
+        names.append("extract")
+    if SUMMARISE_AT_INGEST:
+        names.append("summarise")
+    if derived:
+        names.append("regrid")
+    names.append("index")
+    if PUBLISH_CHANGES:
+        names.append("publish")
+    return names + EXTRA_STAGES
+
 def label_init_to_valid(init_dt: dt.datetime, start_h: int) -> str:
     """
     File title as 'INITDATE-VALIDDATE'.
@@ -270,43 +435,175 @@ def main() -> int:
     logger.info(f"Script start (UTC): {script_start.isoformat(timespec='seconds')}")
     logger.info(f"Base dir: {base_dir}")
 
-    server = ECMWFService("mars")
-
-    run_date = resolve_run_date_yyyymmdd()
-    init_dt = init_datetime_utc(run_date, INIT_TIME_UTC)
-
-    run_dir = build_run_dir(base_dir, run_date, INIT_TIME_UTC)
-    ensure_dir(run_dir)
+    derived = [_parse_grid(g) for g in DERIVED_GRIDS]
+    for g in derived:
+        check_aligned(_parse_grid(GRID), g, _parse_area(AREA))
 
-    failures: List[str] = []
+    if EXTRACT_STATIONS and not STATIONS_CSV.exists():
+        logger.warning(f"No station list at {STATIONS_CSV}, station extraction skipped")
 
-    for day_idx in KEEP_DAY_INDICES:
-        h0, h1 = day_window_hours(day_idx)
-        step_str, ntime = steps_as_list(h0, h1, STEP_HOURS)
-
-        label = label_init_to_valid(init_dt, h0)
-        out_name = f"{label}.nc"
-        out_path = run_dir / out_name
+    server = ECMWFService("mars")
 
-        if nonempty(out_path):
-            logger.info(f"Skip existing: {out_name}")
-            continue
+    avail = Availability(server, base_dir, logger) if CHECK_AVAILABILITY else None
+    if avail is not None:
+        # once per run: drop expired answers so the cache file does not grow forever
+        avail.prune()
 
-        req = build_request(run_date, INIT_TIME_UTC, step_str, logger)
+    run_date = resolve_run_date_yyyymmdd()
+    complete_date: Optional[str] = None   # newest fully archived run, when a newer partial one is served
+    if avail is not None and AUTO_RUN_DATE and RUN_DATE_YYYYMMDD is None:
+        h0, h1 = day_window_hours(max(KEEP_DAY_INDICES))
+        probe = build_request(run_date, INIT_TIME_UTC, steps_as_list(h0, h1, STEP_HOURS)[0], logger)
+        candidates = [yyyymmdd_utc(d) for d in range(RUN_DATE_SEARCH_DAYS + 1)]
+        found = avail.latest_run_date(candidates, probe)
+        if PARTIAL_DOWNLOADS:
+            # serve the newest run as soon as its first step is archived; the
+            # newest complete run is still fetched, as backfill
+            h0, _ = day_window_hours(min(KEEP_DAY_INDICES))
+            first = avail.latest_run_date(candidates, dict(probe, step=str(h0)))
+            if first is not None and (found is None or first > found):
+                complete_date, found = found, first
+        if found is not None:
+            run_date = found
+        logger.info(f"Run date: {run_date}{'' if found else ' (offset fallback)'}"
+                    + (f", partial; newest complete run {complete_date} as backfill" if complete_date else ""))
+    newest = dt.datetime.strptime(run_date, "%Y%m%d")
+
+    queue = JobQueue()
+    for back in range(BACKFILL_DAYS + 1):
+        rd = (newest - dt.timedelta(days=back)).strftime("%Y%m%d")
+        for day_idx in KEEP_DAY_INDICES:
+            queue.push(Job(rd, day_idx, FRESH if back == 0 else BACKFILL))
+    oldest = (newest - dt.timedelta(days=BACKFILL_DAYS)).strftime("%Y%m%d")
+    if complete_date is not None and complete_date < oldest:
+        for day_idx in KEEP_DAY_INDICES:
+            queue.push(Job(complete_date, day_idx, BACKFILL))
+    profile = base_dir.relative_to(DOWNLOAD_ROOT).as_posix()
+    # windows retention compressed, summarised or deleted are not fetched again
+    retired = retired_windows(DOWNLOAD_ROOT, profile)
+    if PARTIAL_DOWNLOADS:
+        # partial windows of older run dates are topped up like backfill
+        for rd, vd in partial_windows(DOWNLOAD_ROOT, profile):
+            day_idx = (dt.datetime.strptime(vd, "%Y%m%d") - dt.datetime.strptime(rd, "%Y%m%d")).days
+            if rd < oldest and rd != complete_date and day_idx in KEEP_DAY_INDICES:
+                queue.push(Job(rd, day_idx, BACKFILL))
 
-        try:
-            mars_execute(server, req, out_path, ntime=ntime, logger=logger)
-        except Exception as e:
-            logger.error(f"FAILED day_idx={day_idx} ({label}): {e}")
-            failures.append(f"day{day_idx}:{label}")
+    failures: List[str] = []
+    unavailable: List[str] = []
+    partial: List[str] = []
+    stages = build_stages(pipeline_stage_names(derived), logger=logger, base_dir=base_dir, derived=derived)
+    pipe = Pipeline(stages, logger)
+
+    bucket = None
+    if BANDWIDTH_CAP_MBPS:
+        bucket = TokenBucket(BANDWIDTH_CAP_MBPS * 1024 * 1024, state_path=DOWNLOAD_ROOT / BUCKET_NAME)
+    ctl = AIMDController(logger, MIN_INFLIGHT, MAX_INFLIGHT, bucket)
+    running: Dict[Future, Tuple[Job, str]] = {}
+
+    def retry(job: Job, label: str, error: object) -> None:
+        logger.error(f"FAILED day_idx={job.day_idx} ({label}): {error}")
+        if not queue.retry(job, REPAIR_ATTEMPTS):
+            failures.append(f"day{job.day_idx}:{label}")
+
+    def collect(done) -> None:
+        # failed downloads, and downloads whose verify stage (checks, rename,
+        # top-up merge) failed in the pipeline
+        for fut in done:
+            job, label = running.pop(fut)
+            e = fut.exception()
+            if e is not None:
+                retry(job, label, e)
+        for item in pipe.take_failed():
+            retry(item.meta["job"], item.meta["label"], item.error)
+
+    with ThreadPoolExecutor(max_workers=MAX_INFLIGHT) as downloads:
+        while True:
+            # take a slot first, so the job is chosen as late as possible
+            # (repairs of requests that just failed are already queued)
+            ctl.acquire()
+            collect([f for f in list(running) if f.done()])
+            job = queue.pop()
+            if job is None:
+                ctl.cancel()
+                if running:
+                    collect(wait(list(running), return_when=FIRST_COMPLETED).done)
+                    continue
+                # all transfers done: their verify stages may still re-queue repairs
+                pipe.drain()
+                collect([])
+                if len(queue):
+                    continue
+                break
+
+            init_dt = init_datetime_utc(job.run_date, INIT_TIME_UTC)
+            run_dir = build_run_dir(base_dir, job.run_date, INIT_TIME_UTC)
+            ensure_dir(run_dir)
+
+            h0, h1 = day_window_hours(job.day_idx)
+            steps = parse_steps(steps_as_list(h0, h1, STEP_HOURS)[0])
+
+            label = label_init_to_valid(init_dt, h0)
+            out_name = f"{label}.nc"
+            out_path = run_dir / out_name
+
+            tier = retired.get(out_path.relative_to(DOWNLOAD_ROOT).as_posix())
+            if tier is not None:
+                logger.info(f"Skip retired ({tier}): {out_name}")
+                ctl.cancel()
+                continue
+
+            piece = None
+            if nonempty(out_path):
+                steps = missing_steps(out_path) if PARTIAL_DOWNLOADS else []
+                if not steps:
+                    logger.info(f"Skip existing: {out_name}")
+                    ctl.cancel()
+                    continue
+                # partial window: ask only for the steps it lacks
+                piece = out_path.with_name(out_name + TOPUP_SUFFIX)
+
+            req = build_request(job.run_date, INIT_TIME_UTC, format_steps(steps), logger)
+            missing: List[int] = []
+
+            if avail is not None and avail.check(req) is False:
+                have = available_prefix(avail, req, steps) if PARTIAL_DOWNLOADS else []
+                if not have:
+                    logger.info(f"Not yet in MARS, not submitted: {out_name}")
+                    unavailable.append(f"day{job.day_idx}:{label}")
+                    ctl.cancel()
+                    continue
+                if len(have) < len(steps):
+                    missing = steps[len(have):]
+                    steps = have
+                    req["step"] = format_steps(steps)
+                    logger.info(f"Partial: {out_name} steps {format_steps(steps)} in MARS, "
+                                f"{format_steps(missing)} not yet")
+                    if f"day{job.day_idx}:{label}" not in partial:
+                        partial.append(f"day{job.day_idx}:{label}")
+
+            fut = downloads.submit(fetch_window, ctl, pipe, req, out_path, logger, piece=piece,
+                                   ntime=len(steps), steps=steps, missing=missing,
+                                   day_idx=job.day_idx, job=job, label=label)
+            running[fut] = (job, label)
+
+    for item in pipe.close():
+        job = item.meta["job"]
+        logger.error(f"FAILED day_idx={job.day_idx} ({item.meta['label']}): {item.error}")
+        failures.append(f"day{job.day_idx}:{item.meta['label']}")
 
     script_end = now_utc()
     logger.info(f"Script end (UTC): {script_end.isoformat(timespec='seconds')}")
     logger.info(f"Elapsed: {script_end - script_start}")
 
+    if unavailable:
+        logger.warning(f"Not available in MARS yet: {', '.join(unavailable)}")
+    if partial:
+        logger.warning(f"Partial, to be topped up on a later run: {', '.join(partial)}")
     if failures:
         logger.warning(f"Some downloads failed: {', '.join(failures)}")
         return 2
+    if unavailable or partial:
+        return 2
 
     logger.info("All requested day windows downloaded successfully.")
     return 0
@@ -12,6 +12,9 @@ from typing import Dict, Tuple, List, Optional
 from ecmwfapi import *
 from ecmwfapi import ECMWFDataServer,ECMWFService
 import math
+from archive_index import register_file
+from publisher import publish_change
+from throttle import BUCKET_NAME, TokenBucket
 #KEYS TO ACCESS THE DATA
 os.environ["ECMWF_API_URL"] = "https://api.ecmwf.int/v1"
 os.environ["ECMWF_API_KEY"] = "fe1dcb573a3baa56c7ac659aa5f35508"
@@ -57,6 +60,13 @@ ABS_MIN_BYTES = 8_000          # raise if you expect bigger domains
 REL_MIN_FACTOR = 0.10          # fail if file is <10% of rough expected size (when expected is large)
 EXPECTED_MIN_TRIGGER = 50_000  # only apply relative check above this expected size
 
+# Append every finished file to the change feed read by mirrors (see publisher.py)
+PUBLISH_CHANGES = True
+
+# Optional cap on the average download rate, shared with the other download
+# scripts writing under DOWNLOAD_ROOT on this host (see throttle.py). None = no cap.
+BANDWIDTH_CAP_MBPS: Optional[float] = None   # MB/s
+
 # ==========================================
 # Helpers
 # ============================================================
@@ -252,6 +262,12 @@ def mars_execute(server: ECMWFService, req: Dict[str, str], target: Path, ntime:
     tmp.replace(target)
     logger.info(f"Done: {target.name} | {size_mb:.2f} MB | {dt_s:.1f} s")
 
+    if PUBLISH_CHANGES:
+        try:
+            publish_change(DOWNLOAD_ROOT, target)
+        except Exception as e:
+            logger.warning(f"Could not publish {target.name} to change feed: {e}")
+
 
 def main() -> int:
     base_dir = build_base_dir()
@@ -272,6 +288,9 @@ def main() -> int:
     ensure_dir(run_dir)
 
     failures: List[str] = []
+    bucket = None
+    if BANDWIDTH_CAP_MBPS:
+        bucket = TokenBucket(BANDWIDTH_CAP_MBPS * 1024 * 1024, state_path=DOWNLOAD_ROOT / BUCKET_NAME)
 
     for day_idx in KEEP_DAY_INDICES:
         h0, h1 = day_window_hours(day_idx)
@@ -287,11 +306,21 @@ def main() -> int:
 
         req = build_request(run_date, INIT_TIME_UTC, step_str, logger)
 
+        if bucket is not None:
+            bucket.wait()
         try:
             mars_execute(server, req, out_path, ntime=ntime, logger=logger)
+            if bucket is not None:
+                bucket.charge(out_path.stat().st_size)
         except Exception as e:
             logger.error(f"FAILED day_idx={day_idx} ({label}): {e}")
             failures.append(f"day{day_idx}:{label}")
+            continue
+
+        try:
+            register_file(DOWNLOAD_ROOT, out_path)
+        except Exception as e:
+            logger.warning(f"Could not index {out_name}: {e}")
 
     script_end = now_utc()
     logger.info(f"Script end (UTC): {script_end.isoformat(timespec='seconds')}")
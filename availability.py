@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import json
+import logging
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# ============================================================
+# Cached MARS availability catalogue
+# ============================================================
+# Before a retrieve is built, ask MARS (cheap "list ... output=cost" request,
+# no data moved) how many fields exist for (expver, date, time, steps) and
+# compare with how many the retrieve would expect. Answers are cached in a
+# small JSON file next to the data:
+#   - positive answers for POSITIVE_TTL_S (archived data does not disappear)
+#   - negative answers for NEGATIVE_TTL_S (data may be uploaded any time)
+# An answer MARS did not let us parse is "unknown" and never blocks a request.
+#
+# steps_present() answers "which of these steps are archived" with a single
+# plain list request (no output=cost): MARS then lists the fields themselves,
+# as an indented key = value tree (default) or as a table with a header row,
+# and a step counts as present when all its param/levelist fields are listed.
+
+CACHE_NAME = "mars_availability.json"
+POSITIVE_TTL_S = 30 * 24 * 3600
+NEGATIVE_TTL_S = 3 * 3600
+
+_FIELDS_RE = re.compile(r"number[_ ]of[_ ]fields\s*[=:]\s*(\d+)", re.IGNORECASE)
+_TREE_RE = re.compile(r"^(\s*)([A-Za-z_]+)\s*=\s*(\S.*?)\s*$")
+_FIELD_KEYS = ("step", "param", "levelist")
+
+
+def count_items(spec: Optional[str]) -> int:
+    """'0/3/6' -> 3, '110/to/137' -> 28, '0/to/21/by/3' -> 8."""
+    if not spec:
+        return 1
+    parts = [p.strip().lower() for p in spec.split("/") if p.strip()]
+    if len(parts) >= 3 and parts[1] == "to":
+        start, end = int(parts[0]), int(parts[2])
+        by = int(parts[4]) if len(parts) >= 5 and parts[3] == "by" else 1
+        return (end - start) // by + 1
+    return len(parts)
+
+
+def expected_fields(req: Dict[str, str]) -> int:
+    return count_items(req.get("param")) * count_items(req.get("step")) * count_items(req.get("levelist"))
+
+
+def _mars_list_request(req: Dict[str, str], output: Optional[str] = "cost") -> str:
+    keys = ["class", "type", "stream", "expver", "levtype", "param", "date", "time", "step", "levelist"]
+    lines = ["list"] + [f"{k}={req[k]}" for k in keys if req.get(k)]
+    if output:
+        lines.append(f"output={output}")
+    return ",\n    ".join(lines)
+
+
+def _table_fields(lines: List[str]) -> List[Dict[str, str]]:
+    header: Optional[List[str]] = None
+    rows = []
+    for line in lines:
+        cols = line.split()
+        if header is None:
+            if "=" not in line and "step" in [c.lower() for c in cols]:
+                header = [c.lower() for c in cols]
+            continue
+        if len(cols) == len(header):
+            rows.append(dict(zip(header, cols)))
+    return rows
+
+
+def _tree_fields(lines: List[str]) -> List[Dict[str, str]]:
+    """Leaves of the indented 'key = a/b/c' tree, each with the keys of its branch."""
+    parsed = [(len(m.group(1)), m.group(2).lower(), m.group(3)) for m in map(_TREE_RE.match, lines) if m]
+    rows = []
+    stack: List[Tuple[int, str, str]] = []
+    for i, (indent, key, value) in enumerate(parsed):
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        stack.append((indent, key, value))
+        if i + 1 == len(parsed) or parsed[i + 1][0] <= indent:
+            branch = {k: v for _, k, v in stack}
+            if "step" in branch:
+                rows.append(branch)
+    return rows
+
+
+def parse_listed_steps(text: str) -> Optional[Dict[int, int]]:
+    """Output of a plain MARS list -> {step: number of fields listed}; None if unreadable."""
+    lines = text.splitlines()
+    rows = _table_fields(lines) or _tree_fields(lines)
+    if not rows:
+        return None
+    fields: Dict[int, set] = {}
+    for row in rows:
+        values = [row.get(k, "").split("/") for k in _FIELD_KEYS]
+        for step in values[0]:
+            try:
+                s = int(step)
+            except ValueError:
+                continue
+            for p in values[1]:
+                for lev in values[2]:
+                    fields.setdefault(s, set()).add((p.strip(), lev.strip()))
+    return {s: len(f) for s, f in fields.items()}
+
+
+class Availability:
+    def __init__(self, server, cache_dir: Path, logger: logging.Logger) -> None:
+        self.server = server
+        self.path = cache_dir / CACHE_NAME
+        self.logger = logger
+        self.cache: Dict[str, Dict[str, object]] = {}
+        if self.path.exists():
+            try:
+                self.cache = json.loads(self.path.read_text(encoding="utf-8"))
+            except ValueError:
+                self.logger.warning(f"Ignoring unreadable availability cache {self.path}")
+
+    @staticmethod
+    def key(req: Dict[str, str]) -> str:
+        return "|".join(str(req.get(k, "")) for k in
+                        ("class", "stream", "type", "expver", "levtype", "param", "levelist",
+                         "date", "time", "step"))
+
+    def save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".part")
+        tmp.write_text(json.dumps(self.cache, indent=0, sort_keys=True), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def _cached(self, k: str) -> Optional[Dict[str, object]]:
+        ent = self.cache.get(k)
+        if ent is None or ent.get("available") is None:
+            return None
+        ttl = POSITIVE_TTL_S if ent["available"] else NEGATIVE_TTL_S
+        if time.time() - float(ent["checked"]) > ttl:
+            return None
+        return ent
+
+    def query_fields(self, req: Dict[str, str]) -> Optional[int]:
+        """Ask MARS how many fields match `req`. None if the answer can't be read."""
+        with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as tf:
+            out = Path(tf.name)
+        try:
+            self.server.execute(_mars_list_request(req), str(out))
+            m = _FIELDS_RE.search(out.read_text(encoding="utf-8", errors="replace"))
+            return int(m.group(1)) if m else None
+        finally:
+            out.unlink(missing_ok=True)
+
+    def check(self, req: Dict[str, str]) -> Optional[bool]:
+        """
+        True  -> every expected field exists, submit.
+        False -> not (fully) there yet, skip.
+        None  -> unknown (list failed/unparseable), caller should submit anyway.
+        """
+        k = self.key(req)
+        ent = self._cached(k)
+        if ent is not None:
+            return bool(ent["available"])
+
+        expected = expected_fields(req)
+        try:
+            found = self.query_fields(req)
+        except Exception as e:
+            self.logger.warning(f"MARS list failed for date={req.get('date')} step={req.get('step')}: {e}")
+            return None
+        if found is None:
+            return None
+
+        ok = found >= expected
+        self.cache[k] = {"available": ok, "fields": found, "expected": expected, "checked": time.time()}
+        self.save()
+        self.logger.info(f"Availability date={req.get('date')} time={req.get('time')} "
+                         f"step={req.get('step')}: {found}/{expected} fields")
+        return ok
+
+    def steps_present(self, req: Dict[str, str]) -> Optional[List[int]]:
+        """
+        Which of the request's steps MARS has all fields of, from one list
+        request. None if the listing failed or could not be read.
+        """
+        k = "steps|" + self.key(req)
+        ent = self._cached(k)
+        if ent is not None:
+            return [int(s) for s in ent["steps"]]
+
+        per_step = count_items(req.get("param")) * count_items(req.get("levelist"))
+        with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as tf:
+            out = Path(tf.name)
+        try:
+            self.server.execute(_mars_list_request(req, output=None), str(out))
+            listed = parse_listed_steps(out.read_text(encoding="utf-8", errors="replace"))
+        except Exception as e:
+            self.logger.warning(f"MARS list failed for date={req.get('date')} step={req.get('step')}: {e}")
+            return None
+        finally:
+            out.unlink(missing_ok=True)
+        if listed is None:
+            return None
+
+        wanted = [int(s) for s in str(req.get("step", "")).split("/") if s.strip()]
+        present = [s for s in wanted if listed.get(s, 0) >= per_step]
+        self.cache[k] = {"available": len(present) == len(wanted), "steps": present, "checked": time.time()}
+        self.save()
+        self.logger.info(f"Steps in MARS date={req.get('date')} time={req.get('time')}: "
+                         f"{'/'.join(map(str, present)) or 'none'} of {req.get('step')}")
+        return present
+
+    def latest_run_date(self, candidates: List[str], probe: Dict[str, str]) -> Optional[str]:
+        """First run date (newest first) whose `probe` request is available."""
+        for date in candidates:
+            if self.check(dict(probe, date=date)):
+                return date
+        return None
+
+    def prune(self) -> None:
+        """Drop expired entries so the cache file stays small."""
+        now = time.time()
+        self.cache = {
+            k: v for k, v in self.cache.items()
+            if now - float(v["checked"]) <= (POSITIVE_TTL_S if v["available"] else NEGATIVE_TTL_S)
+        }
+        self.save()
+# %%
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import logging
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from netCDF4 import Dataset
+
+from archive_index import parse_window_path
+
+# ============================================================
+# Daily summary products (computed at ingest, or backfilled)
+# ============================================================
+# For every downloaded day window "<label>.nc" a small "<label>.summary.npz"
+# is written next to it holding, per variable:
+#   <var>_mean / <var>_max / <var>_p<q>            -> (lat, lon) int16 or float32 fields
+#   <var>_scale_factor / <var>_add_offset          -> unpacking: x = packed*scale + offset
+#   <var>@<region>_mean / _max / _p<q>             -> float32 scalars
+# Fields of packed variables are packed with the source variable's own
+# scale/offset, so no precision is lost beyond what the NetCDF file already
+# had. Variables without a scale_factor are stored as float32 (scale 1,
+# offset 0, NaN for missing).
+# Reductions run over the step (time) dimension, i.e. one day of 3-hourly steps.
+#
+# Usage:
+#   python daily_summaries.py rebuild [ROOT]   # backfill missing/stale summaries
+
+DOWNLOAD_ROOT = Path("/home/agkiokas/MARS/data/")
+
+# NetCDF variable names of the params we summarise (207.210 / 209.210)
+SUMMARY_VARS = ["aod550", "duaod550"]
+PERCENTILES = [50, 90, 95]
+
+# Regions as "N/W/S/E" (same convention as AREA)
+REGIONS: Dict[str, str] = {
+    "EUROPE": "72/-25/34/45",
+    "MEDITERRANEAN": "46/-6/30/36",
+    "SAHARA": "35/-18/15/35",
+}
+
+SUMMARY_WORKERS = 4
+SUMMARY_SUFFIX = ".summary.npz"
+PACKED_FILL = np.int16(-32767)
+
+
+def summary_path(nc_path: Path) -> Path:
+    return nc_path.with_name(nc_path.stem + SUMMARY_SUFFIX)
+
+
+def _region_slices(lat: np.ndarray, lon: np.ndarray, area: str) -> Tuple[np.ndarray, np.ndarray]:
+    n, w, s, e = (float(x) for x in area.split("/"))
+    lat_idx = np.nonzero((lat <= n) & (lat >= s))[0]
+    lon_idx = np.nonzero((lon >= w) & (lon <= e))[0]
+    return lat_idx, lon_idx
+
+
+def _pack(field: np.ndarray, scale: Optional[float], offset: float) -> np.ndarray:
+    if scale is None:
+        return field.astype(np.float32)
+    packed = np.round((field - offset) / scale)
+    packed = np.clip(packed, -32766, 32767)
+    return np.where(np.isfinite(field), packed, PACKED_FILL).astype(np.int16)
+
+
+def summarise_window(nc_path: Path) -> Path:
+    """
+    Compute daily reductions for one window file and write them next to it.
+    Runs in a worker process; returns the summary path.
+    """
+    out: Dict[str, np.ndarray] = {}
+    with Dataset(nc_path) as ds:
+        lat = np.asarray(ds.variables["latitude"][:], dtype=np.float64)
+        lon = np.asarray(ds.variables["longitude"][:], dtype=np.float64)
+        out["latitude"] = lat.astype(np.float32)
+        out["longitude"] = lon.astype(np.float32)
+        out["time"] = np.asarray(ds.variables["time"][:])
+
+        regions = {name: _region_slices(lat, lon, area) for name, area in REGIONS.items()}
+
+        for var in SUMMARY_VARS:
+            if var not in ds.variables:
+                continue
+            # (time, lat, lon), scale_factor/add_offset applied, fill -> NaN
+            v = ds.variables[var]
+            data = np.ma.filled(v[:].astype(np.float32), np.nan)
+            packed = hasattr(v, "scale_factor") and v.dtype.kind in "iu"
+            scale = float(v.scale_factor) if packed else None
+            offset = float(getattr(v, "add_offset", 0.0)) if packed else 0.0
+            out[f"{var}_scale_factor"] = np.float64(scale if packed else 1.0)
+            out[f"{var}_add_offset"] = np.float64(offset)
+
+            out[f"{var}_mean"] = _pack(np.nanmean(data, axis=0), scale, offset)
+            out[f"{var}_max"] = _pack(np.nanmax(data, axis=0), scale, offset)
+            # nanpercentile along an axis is a Python loop per cell; only pay
+            # for it when there actually are missing values
+            pct_fn = np.percentile if np.isfinite(data).all() else np.nanpercentile
+            pct = pct_fn(data, PERCENTILES, axis=0)
+            for q, field in zip(PERCENTILES, pct):
+                out[f"{var}_p{q}"] = _pack(field, scale, offset)
+
+            for name, (ii, jj) in regions.items():
+                if ii.size == 0 or jj.size == 0:
+                    continue
+                vals = data[:, ii[0]:ii[-1] + 1, jj[0]:jj[-1] + 1].ravel()
+                out[f"{var}@{name}_mean"] = np.float32(np.nanmean(vals))
+                out[f"{var}@{name}_max"] = np.float32(np.nanmax(vals))
+                for q, v in zip(PERCENTILES, np.nanpercentile(vals, PERCENTILES)):
+                    out[f"{var}@{name}_p{q}"] = np.float32(v)
+
+    target = summary_path(nc_path)
+    tmp = target.with_name(target.name + ".part")
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **out)
+    tmp.replace(target)
+    return target
+
+
+class SummaryPool:
+    """
+    Worker pool for summaries. submit() returns immediately so the download
+    loop is not delayed; drain() waits for everything and logs the outcome.
+    """
+
+    def __init__(self, logger: logging.Logger, workers: int = SUMMARY_WORKERS) -> None:
+        self.logger = logger
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.pending: Dict[Future, Path] = {}
+
+    def submit(self, nc_path: Path) -> None:
+        self.pending[self.pool.submit(summarise_window, nc_path)] = nc_path
+
+    def drain(self) -> List[Path]:
+        failed: List[Path] = []
+        for fut in as_completed(self.pending):
+            src = self.pending[fut]
+            try:
+                self.logger.info(f"Summary: {fut.result().name}")
+            except Exception as e:
+                self.logger.error(f"Summary FAILED for {src.name}: {e}")
+                failed.append(src)
+        self.pending.clear()
+        self.pool.shutdown()
+        return failed
+
+
+def needs_summary(nc_path: Path) -> bool:
+    sp = summary_path(nc_path)
+    return not sp.exists() or sp.stat().st_mtime < nc_path.stat().st_mtime
+
+
+def rebuild(root: Path, logger: logging.Logger) -> int:
+    # window files only: not the derived grids (grid_*/) or anything else named *.nc
+    todo = sorted(p for p in root.rglob("*.nc")
+                  if p.is_file() and parse_window_path(root, p) is not None and needs_summary(p))
+    logger.info(f"Rebuilding {len(todo)} summaries under {root}")
+    pool = SummaryPool(logger)
+    for p in todo:
+        pool.submit(p)
+    failed = pool.drain()
+    if failed:
+        logger.warning(f"{len(failed)} summaries failed")
+        return 2
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    if not args or args[0] != "rebuild":
+        print("usage: daily_summaries.py rebuild [ROOT]", file=sys.stderr)
+        return 1
+    root = Path(args[1]) if len(args) > 1 else DOWNLOAD_ROOT
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    return rebuild(root, logging.getLogger("cams_mars"))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import datetime as dt
+import json
+import re
+import sys
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# ============================================================
+# Historical performance report from CAMS_mars_fc.log
+# ============================================================
+# Stream-parses one or more download logs (and JSON journals, one JSON
+# object per line) and prints latency/throughput/failure statistics.
+# Memory use does not grow with the log length: quantiles are tracked
+# with the P² estimator (Jain & Chlamtac, 1985).
+#
+# Usage:
+#   python log_report.py                      # uses LOG_PATHS below
+#   python log_report.py a.log b.jsonl ...    # explicit files
+
+LOG_PATHS = [Path("/home/agkiokas/MARS/data/EUROPE/icki/FC/SFC/CAMS_mars_fc.log")]
+
+# Must match KEEP_DAY_INDICES of the run that wrote the log: the n-th window
+# handled in a run ("Skip existing"/"Skip retired"/"Downloading") is day KEEP_DAY_INDICES[n].
+# Only used when the file label itself does not tell the window.
+KEEP_DAY_INDICES = [0, 2, 4]
+
+QUANTILES = (0.50, 0.95)
+
+# ==========================================
+# Streaming quantiles
+# ============================================================
+class P2Quantile:
+    """
+    P² single-quantile estimator: five markers, O(1) memory.
+    Exact for the first five observations.
+    """
+
+    def __init__(self, p: float) -> None:
+        self.p = p
+        self.q: List[float] = []
+        self.n = [0, 1, 2, 3, 4]
+        self.np = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self.dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+        self.count = 0
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        if self.count <= 5:
+            self.q.append(x)
+            self.q.sort()
+            return
+
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if d >= 0 else -1
+                qp = self._parabolic(i, s)
+                if not (q[i - 1] < qp < q[i + 1]):
+                    qp = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                q[i] = qp
+                n[i] += s
+
+    def _parabolic(self, i: int, s: int) -> float:
+        q, n = self.q, self.n
+        return q[i] + s / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> Optional[float]:
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            # nearest-rank on the exact sample
+            idx = min(len(self.q) - 1, max(0, int(round(self.p * (len(self.q) - 1)))))
+            return self.q[idx]
+        return self.q[2]
+
+
+class Stats:
+    """Running count/sum/min/max plus the configured quantiles."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.quantiles = {p: P2Quantile(p) for p in QUANTILES}
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        self.total += x
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        for est in self.quantiles.values():
+            est.add(x)
+
+    def q(self, p: float) -> Optional[float]:
+        return self.quantiles[p].value()
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+# ==========================================
+# Parsing
+# ============================================================
+# A parsed event is (timestamp, kind, fields); kinds are
+# start / skip / download / done / failed / end.
+Event = Tuple[dt.datetime, str, Dict[str, object]]
+
+_START_UTC_RE = re.compile(r"^Script start \(UTC\): (\S+)$")
+_LINE_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) \| (\w+) \| (.*)$")
+_DONE_RE = re.compile(r"^Done: (?P<file>.+?) \| (?P<mb>[\d.]+) MB \| (?P<seconds>[\d.]+) s$")
+_FAILED_RE = re.compile(r"^FAILED (?P<who>.+?): (?P<error>.*)$")
+_ELAPSED_RE = re.compile(r"^Elapsed: (?:(?P<days>\d+) days?, )?(?P<h>\d+):(?P<m>\d+):(?P<s>[\d.]+)$")
+_DAY_IDX_RE = re.compile(r"day_idx=(\d+)")
+_LABEL_RE = re.compile(r"(\d{2}_\d{2}_\d{4})-(\d{2}_\d{2}_\d{4})")
+_D_SUFFIX_RE = re.compile(r"_D(\d+)\b")
+
+
+def _parse_text_line(line: str) -> Optional[Event]:
+    m = _LINE_RE.match(line)
+    if not m:
+        return None
+    ts = dt.datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S").replace(
+        microsecond=int(m.group(2)) * 1000
+    )
+    msg = m.group(4).strip()
+
+    if msg.startswith("Script start"):
+        # asctime is the host's local time; the start line also carries UTC
+        mu = _START_UTC_RE.match(msg)
+        if mu:
+            try:
+                utc = dt.datetime.fromisoformat(mu.group(1))
+            except ValueError:
+                return ts, "start", {}
+            if utc.tzinfo is not None:
+                # a naive stamp is already UTC; astimezone() would read it as local
+                utc = utc.astimezone(dt.timezone.utc).replace(tzinfo=None)
+            offset = ts - utc
+            quarter = round(offset.total_seconds() / 900) * 900
+            return ts, "start", {"utc_offset_s": quarter}
+        return ts, "start", {}
+    if msg.startswith(("Skip existing:", "Skip retired")):
+        return ts, "skip", {"file": msg.split(":", 1)[1].strip()}
+    if msg.startswith("Downloading ->"):
+        return ts, "download", {"file": msg.split("->", 1)[1].strip()}
+    md = _DONE_RE.match(msg)
+    if md:
+        return ts, "done", {"file": md["file"], "mb": float(md["mb"]), "seconds": float(md["seconds"])}
+    mf = _FAILED_RE.match(msg)
+    if mf:
+        return ts, "failed", {"who": mf["who"], "error": mf["error"]}
+    me = _ELAPSED_RE.match(msg)
+    if me:
+        secs = (int(me["days"] or 0) * 86400 + int(me["h"]) * 3600
+                + int(me["m"]) * 60 + float(me["s"]))
+        return ts, "end", {"seconds": secs}
+    return None
+
+
+def _parse_json_line(line: str) -> Optional[Event]:
+    """
+    Journal schema: {"ts": ISO-8601, "event": kind, ...fields}; the fields
+    are the same as for text lines (file, mb, seconds, error, who).
+    """
+    try:
+        rec = json.loads(line)
+        kind = str(rec.pop("event"))
+        ts = dt.datetime.fromisoformat(str(rec.pop("ts")))
+    except (ValueError, KeyError, TypeError):
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return ts, kind, rec
+
+
+def iter_events(paths: Iterable[Path]) -> Iterator[Event]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                ev = _parse_json_line(line) if line.startswith("{") else _parse_text_line(line)
+                if ev is not None:
+                    yield ev
+
+
+def error_class(msg: str) -> str:
+    m = re.search(r"ERROR \d+ \((\w+)\)", msg)
+    if m:
+        return m.group(1)
+    low = msg.lower()
+    if "has no access" in low:
+        return "NO_ACCESS"
+    if "too small" in low:
+        return "TOO_SMALL"
+    if "is not valid" in low:
+        return "INVALID_OUTPUT"
+    if "produced no file" in low:
+        return "NO_FILE"
+    if "timed out" in low or "timeout" in low:
+        return "TIMEOUT"
+    return "OTHER"
+
+
+def window_key(name: str, slot: int) -> str:
+    m = _D_SUFFIX_RE.search(name)
+    if m:
+        return f"D{m.group(1)}"
+    m = _DAY_IDX_RE.search(name)
+    if m:
+        return f"day{m.group(1)}"
+    m = _LABEL_RE.search(name)
+    if m and m.group(1) != m.group(2):
+        d0 = dt.datetime.strptime(m.group(1), "%d_%m_%Y")
+        d1 = dt.datetime.strptime(m.group(2), "%d_%m_%Y")
+        return f"day{(d1 - d0).days}"
+    if slot < len(KEEP_DAY_INDICES):
+        return f"day{KEEP_DAY_INDICES[slot]}"
+    return f"slot{slot}"
+
+
+# ==========================================
+# Aggregation
+# ============================================================
+class Report:
+    def __init__(self) -> None:
+        self.latency_by_window: Dict[str, Stats] = {}
+        self.latency_by_hour: Dict[int, Stats] = {}
+        self.throughput = Stats()
+        self.latency = Stats()
+        self.run_elapsed = Stats()
+        self.attempts = 0
+        self.failures_by_class: Dict[str, int] = {}
+        self.runs = 0
+        self.noop_runs = 0
+        self.incomplete_runs = 0
+        self.first_ts: Optional[dt.datetime] = None
+        self.last_ts: Optional[dt.datetime] = None
+
+        # per-run state
+        self._in_run = False
+        self._slot = 0
+        self._downloads_in_run = 0
+        self._window_of: Dict[str, str] = {}
+        self._utc_offset = dt.timedelta(0)
+
+    def _begin_run(self) -> None:
+        if self._in_run:
+            # previous run never logged "Elapsed" (crash/kill)
+            self.incomplete_runs += 1
+        self._in_run = True
+        self._slot = 0
+        self._downloads_in_run = 0
+        self._window_of.clear()
+
+    def feed(self, ev: Event) -> None:
+        ts, kind, f = ev
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+
+        if kind == "start":
+            self._begin_run()
+            self._utc_offset = dt.timedelta(seconds=float(f.get("utc_offset_s", 0.0)))
+        elif kind == "skip":
+            self._slot += 1
+        elif kind == "download":
+            name = str(f.get("file", ""))
+            self._window_of[name] = window_key(name, self._slot)
+            self._slot += 1
+            self._downloads_in_run += 1
+            self.attempts += 1
+        elif kind == "done":
+            name = str(f.get("file", ""))
+            secs = float(f.get("seconds", 0.0))
+            mb = float(f.get("mb", 0.0))
+            win = self._window_of.get(name) or window_key(name, self._slot)
+            hour = (ts - self._utc_offset - dt.timedelta(seconds=secs)).hour
+            self.latency.add(secs)
+            self.latency_by_window.setdefault(win, Stats()).add(secs)
+            self.latency_by_hour.setdefault(hour, Stats()).add(secs)
+            if secs > 0 and mb > 0:
+                self.throughput.add(mb / secs)
+        elif kind == "failed":
+            cls = error_class(str(f.get("error", "")))
+            self.failures_by_class[cls] = self.failures_by_class.get(cls, 0) + 1
+        elif kind == "end":
+            self.runs += 1
+            if self._in_run and self._downloads_in_run == 0:
+                self.noop_runs += 1
+            self.run_elapsed.add(float(f.get("seconds", 0.0)))
+            self._in_run = False
+
+    def finish(self) -> None:
+        if self._in_run:
+            self.incomplete_runs += 1
+            self._in_run = False
+
+
+def _fmt(x: Optional[float], unit: str = "", nd: int = 1) -> str:
+    return "-" if x is None else f"{x:.{nd}f}{unit}"
+
+
+def _stats_row(label: str, s: Stats, unit: str = " s") -> str:
+    return (f"  {label:<10} n={s.count:<5} p50={_fmt(s.q(0.50), unit):<10} "
+            f"p95={_fmt(s.q(0.95), unit):<10} max={_fmt(s.max if s.count else None, unit)}")
+
+
+def render(r: Report) -> str:
+    out: List[str] = []
+    span = f"{r.first_ts} .. {r.last_ts}" if r.first_ts else "empty"
+    out.append(f"Period: {span}")
+    out.append(f"Runs: {r.runs} completed | {r.noop_runs} no-op | {r.incomplete_runs} incomplete")
+    out.append(_stats_row("run time", r.run_elapsed))
+    out.append("")
+    out.append("Download latency:")
+    out.append(_stats_row("all", r.latency))
+    out.append("Per window:")
+    for k in sorted(r.latency_by_window):
+        out.append(_stats_row(k, r.latency_by_window[k]))
+    out.append("Per hour of day (UTC, by download start):")
+    for h in sorted(r.latency_by_hour):
+        out.append(_stats_row(f"{h:02d}h", r.latency_by_hour[h]))
+    out.append("")
+    t = r.throughput
+    out.append(f"Throughput: mean={_fmt(t.mean, ' MB/s', 3)} p50={_fmt(t.q(0.50), ' MB/s', 3)} "
+               f"p95={_fmt(t.q(0.95), ' MB/s', 3)}")
+    out.append("")
+    nfail = sum(r.failures_by_class.values())
+    rate = nfail / r.attempts if r.attempts else 0.0
+    out.append(f"Failures: {nfail}/{r.attempts} attempts ({rate:.1%})")
+    for cls, n in sorted(r.failures_by_class.items(), key=lambda kv: -kv[1]):
+        share = n / r.attempts if r.attempts else 0.0
+        out.append(f"  {cls:<24} {n:<5} ({share:.1%} of attempts)")
+    return "\n".join(out)
+
+
+def build_report(paths: Iterable[Path]) -> Report:
+    r = Report()
+    for ev in iter_events(paths):
+        r.feed(ev)
+    r.finish()
+    return r
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    paths = [Path(a) for a in args] if args else LOG_PATHS
+    missing = [p for p in paths if not p.exists()]
+    if missing:
+        print(f"Log file(s) not found: {', '.join(str(p) for p in missing)}", file=sys.stderr)
+        return 1
+    print(render(build_report(paths)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
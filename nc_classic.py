@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import os
+import struct
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# ============================================================
+# Zero-copy reader for NetCDF classic files (CDF1 / CDF2 / CDF5)
+# ============================================================
+# MARS "format": "netcdf" output is classic format (magic b"CDF", see
+# _magic_ok() in auto_download.py). Variables live at fixed offsets given in
+# the header, so once the header is parsed every variable can be exposed as a
+# numpy.memmap view and sliced without reading the rest of the file.
+#
+#   nc = open_classic(path)
+#   aod = nc["aod550"]                  # Var, nothing read yet
+#   aod.raw[2:4]                        # packed int16 view (memmap)
+#   aod[2:4, 10:20, 30:40]              # scale_factor/add_offset/fill applied
+#   extract_box(path, "aod550", box="45/0/35/20", steps=slice(0, 4))
+#
+# Headers are cached per (path, mtime, size); the memmap itself is opened
+# lazily and shared by all variables of a file.
+
+_NC_DIMENSION = 0x0A
+_NC_VARIABLE = 0x0B
+_NC_ATTRIBUTE = 0x0C
+
+_NC_TYPES: Dict[int, str] = {
+    1: "i1",   # NC_BYTE
+    2: "S1",   # NC_CHAR
+    3: ">i2",  # NC_SHORT
+    4: ">i4",  # NC_INT
+    5: ">f4",  # NC_FLOAT
+    6: ">f8",  # NC_DOUBLE
+    # CDF5 only
+    7: "u1",
+    8: ">u2",
+    9: ">u4",
+    10: ">i8",
+    11: ">u8",
+}
+
+AttrValue = Union[str, np.ndarray, int, float]
+
+
+class _HeaderReader:
+    def __init__(self, f: BinaryIO, version: int) -> None:
+        self.f = f
+        self.version = version   # 1, 2 or 5
+
+    def _read(self, n: int) -> bytes:
+        b = self.f.read(n)
+        if len(b) != n:
+            raise ValueError("Truncated NetCDF header")
+        return b
+
+    def i32(self) -> int:
+        return struct.unpack(">i", self._read(4))[0]
+
+    def i64(self) -> int:
+        return struct.unpack(">q", self._read(8))[0]
+
+    def count(self) -> int:
+        # NON_NEG: 32-bit in CDF1/2, 64-bit in CDF5
+        return self.i64() if self.version == 5 else self.i32()
+
+    def offset(self) -> int:
+        return self.i32() if self.version == 1 else self.i64()
+
+    def name(self) -> str:
+        n = self.count()
+        raw = self._read((n + 3) // 4 * 4)
+        return raw[:n].decode("utf-8")
+
+    def attrs(self) -> Dict[str, AttrValue]:
+        tag = self.i32()
+        n = self.count()
+        if tag not in (0, _NC_ATTRIBUTE):
+            raise ValueError(f"Bad attribute list tag {tag:#x}")
+        out: Dict[str, AttrValue] = {}
+        for _ in range(n):
+            name = self.name()
+            nc_type = self.i32()
+            nelems = self.count()
+            dtype = np.dtype(_NC_TYPES[nc_type])
+            raw = self._read((nelems * dtype.itemsize + 3) // 4 * 4)[: nelems * dtype.itemsize]
+            if nc_type == 2:
+                out[name] = raw.decode("utf-8", errors="replace").rstrip("\x00")
+            else:
+                arr = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder("="))
+                out[name] = arr[0] if arr.size == 1 else arr
+        return out
+
+
+class Header:
+    """Parsed classic header: dims, global attrs and variable layout."""
+
+    def __init__(self, version: int, numrecs: int, dims: List[Tuple[str, int]],
+                 attrs: Dict[str, AttrValue], variables: Dict[str, "VarInfo"], recsize: int) -> None:
+        self.version = version
+        self.numrecs = numrecs
+        self.dims = dims
+        self.attrs = attrs
+        self.variables = variables
+        self.recsize = recsize
+
+    @property
+    def record_dim(self) -> Optional[str]:
+        for name, size in self.dims:
+            if size == 0:
+                return name
+        return None
+
+
+class VarInfo:
+    def __init__(self, name: str, dims: List[str], shape: Tuple[int, ...], dtype: np.dtype,
+                 attrs: Dict[str, AttrValue], begin: int, is_record: bool, vsize: int = 0) -> None:
+        self.name = name
+        self.dims = dims
+        self.shape = shape          # record dim counts numrecs
+        self.dtype = dtype
+        self.attrs = attrs
+        self.begin = begin
+        self.is_record = is_record
+        self.vsize = vsize          # as in the header: bytes per variable (per record if is_record)
+
+
+def parse_header(f: BinaryIO) -> Header:
+    magic = f.read(4)
+    if magic[:3] != b"CDF" or magic[3] not in (1, 2, 5):
+        raise ValueError("Not a NetCDF classic file (CDF1/CDF2/CDF5)")
+    r = _HeaderReader(f, magic[3])
+    numrecs = r.count()
+
+    tag = r.i32()
+    ndims = r.count()
+    if tag not in (0, _NC_DIMENSION):
+        raise ValueError(f"Bad dimension list tag {tag:#x}")
+    dims = [(r.name(), r.count()) for _ in range(ndims)]
+
+    gattrs = r.attrs()
+
+    tag = r.i32()
+    nvars = r.count()
+    if tag not in (0, _NC_VARIABLE):
+        raise ValueError(f"Bad variable list tag {tag:#x}")
+
+    raw_vars = []
+    for _ in range(nvars):
+        name = r.name()
+        ndim = r.count()
+        dimids = [r.count() for _ in range(ndim)]
+        vattrs = r.attrs()
+        dtype = np.dtype(_NC_TYPES[r.i32()])
+        vsize = r.count()
+        begin = r.offset()
+        raw_vars.append((name, dimids, vattrs, dtype, vsize, begin))
+
+    variables: Dict[str, VarInfo] = {}
+    rec_vars = []
+    for name, dimids, vattrs, dtype, vsize, begin in raw_vars:
+        is_record = bool(dimids) and dims[dimids[0]][1] == 0
+        shape = tuple(numrecs if (i == 0 and is_record) else dims[d][1] for i, d in enumerate(dimids))
+        variables[name] = VarInfo(name, [dims[d][0] for d in dimids], shape, dtype, vattrs, begin, is_record, vsize)
+        if is_record:
+            rec_vars.append((dtype, shape, vsize))
+
+    # One record = one slab of every record variable, each padded to 4 bytes,
+    # except when there is a single record variable (then no padding).
+    if len(rec_vars) == 1:
+        dtype, shape, _ = rec_vars[0]
+        recsize = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+    else:
+        recsize = sum(v for _, _, v in rec_vars)
+
+    return Header(magic[3], numrecs, dims, gattrs, variables, recsize)
+
+
+@lru_cache(maxsize=256)
+def _cached_header(path: str, mtime_ns: int, size: int) -> Header:
+    with open(path, "rb") as f:
+        return parse_header(f)
+
+
+def read_header(path: Path) -> Header:
+    st = Path(path).stat()
+    return _cached_header(str(path), st.st_mtime_ns, st.st_size)
+
+
+# ==========================================
+# Variables
+# ============================================================
+class Var:
+    """
+    Lazy view on one variable. `raw` is the packed memmap view; indexing the
+    Var itself returns float32 with scale_factor/add_offset applied and
+    _FillValue/missing_value turned into NaN, for the selected part only.
+    """
+
+    def __init__(self, nc: "ClassicFile", info: VarInfo) -> None:
+        self.nc = nc
+        self.info = info
+        self.name = info.name
+        self.dims = info.dims
+        self.shape = info.shape
+        self.attrs = info.attrs
+        self._raw: Optional[np.ndarray] = None
+
+    @property
+    def raw(self) -> np.ndarray:
+        if self._raw is None:
+            info = self.info
+            itemsize = info.dtype.itemsize
+            inner = info.shape[1:] if info.is_record else info.shape
+            strides: List[int] = []
+            acc = itemsize
+            for n in reversed(inner):
+                strides.insert(0, acc)
+                acc *= n
+            if info.is_record:
+                strides.insert(0, self.nc.header.recsize)
+            self._raw = np.ndarray(info.shape, dtype=info.dtype, buffer=self.nc.mm,
+                                   offset=info.begin, strides=tuple(strides))
+        return self._raw
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.unpack(self.raw[key])
+
+    def unpack(self, packed: np.ndarray) -> np.ndarray:
+        out = np.asarray(packed, dtype=np.float32)
+        missing = None
+        for k in ("_FillValue", "missing_value"):
+            if k in self.attrs:
+                m = packed == self.attrs[k]
+                missing = m if missing is None else (missing | m)
+        scale = self.attrs.get("scale_factor")
+        offset = self.attrs.get("add_offset")
+        if scale is not None:
+            out = out * np.float32(scale)
+        if offset is not None:
+            out = out + np.float32(offset)
+        if missing is not None and np.any(missing):
+            out = np.where(missing, np.float32(np.nan), out)
+        return out
+
+
+class ClassicFile:
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.header = read_header(self.path)
+        self._mm: Optional[np.memmap] = None
+        self._vars: Dict[str, Var] = {}
+
+    @property
+    def mm(self) -> np.memmap:
+        if self._mm is None:
+            self._mm = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return self._mm
+
+    @property
+    def variables(self) -> Dict[str, VarInfo]:
+        return self.header.variables
+
+    @property
+    def attrs(self) -> Dict[str, AttrValue]:
+        return self.header.attrs
+
+    def __getitem__(self, name: str) -> Var:
+        if name not in self._vars:
+            self._vars[name] = Var(self, self.header.variables[name])
+        return self._vars[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.header.variables
+
+    def coord(self, name: str) -> np.ndarray:
+        return np.asarray(self[name][:], dtype=np.float64)
+
+
+def open_classic(path: Path) -> ClassicFile:
+    return ClassicFile(path)
+
+
+# ==========================================
+# Step / box / point selection
+# ============================================================
+def _box_slices(lat: np.ndarray, lon: np.ndarray, box: str) -> Tuple[slice, slice]:
+    """'N/W/S/E' -> contiguous index slices on (possibly descending) lat/lon axes."""
+    n, w, s, e = (float(x) for x in box.split("/"))
+    ii = np.nonzero((lat <= n) & (lat >= s))[0]
+    jj = np.nonzero((lon >= w) & (lon <= e))[0]
+    if ii.size == 0 or jj.size == 0:
+        raise ValueError(f"Box {box} does not intersect the grid")
+    return slice(int(ii[0]), int(ii[-1]) + 1), slice(int(jj[0]), int(jj[-1]) + 1)
+
+
+def nearest_index(axis: np.ndarray, values: Sequence[float]) -> np.ndarray:
+    return np.abs(axis[None, :] - np.asarray(values, dtype=np.float64)[:, None]).argmin(axis=1)
+
+
+def extract_box(path: Path, var: str, box: Optional[str] = None,
+                steps: Union[slice, Sequence[int], None] = None,
+                lat_name: str = "latitude", lon_name: str = "longitude") -> Dict[str, np.ndarray]:
+    """
+    Read `var` (time, lat, lon) for a step selection and an 'N/W/S/E' box.
+    Only the touched pages of the file are read.
+    """
+    nc = open_classic(path)
+    lat = nc.coord(lat_name)
+    lon = nc.coord(lon_name)
+    si = slice(None) if steps is None else steps
+    if box is None:
+        sl, sj = slice(None), slice(None)
+    else:
+        sl, sj = _box_slices(lat, lon, box)
+    v = nc[var]
+    return {
+        var: v[si, sl, sj],
+        "time": nc["time"].raw[si].astype(np.float64),
+        lat_name: lat[sl],
+        lon_name: lon[sj],
+    }
+
+
+def extract_points(path: Path, var: str, lats: Sequence[float], lons: Sequence[float],
+                   steps: Union[slice, Sequence[int], None] = None,
+                   lat_name: str = "latitude", lon_name: str = "longitude") -> np.ndarray:
+    """Nearest-gridpoint values of `var` -> array (step, point)."""
+    nc = open_classic(path)
+    ii = nearest_index(nc.coord(lat_name), lats)
+    jj = nearest_index(nc.coord(lon_name), lons)
+    v = nc[var]
+    raw = v.raw if steps is None else v.raw[steps]
+    return v.unpack(raw[:, ii, jj])
+
+
+# ==========================================
+# Writer (CDF2, 64-bit offsets)
+# ============================================================
+_NC_TYPE_OF = {np.dtype(v).newbyteorder("="): k for k, v in _NC_TYPES.items() if k <= 6}
+
+
+def _pad4(b: bytes) -> bytes:
+    return b + b"\x00" * (-len(b) % 4)
+
+
+def _nc_type(dtype: np.dtype) -> int:
+    dt_ = np.dtype(dtype).newbyteorder("=") if np.dtype(dtype).itemsize > 1 else np.dtype(dtype)
+    if dt_ not in _NC_TYPE_OF:
+        raise ValueError(f"Type {dtype} not representable in NetCDF classic")
+    return _NC_TYPE_OF[dt_]
+
+
+def _enc_name(name: str) -> bytes:
+    raw = name.encode("utf-8")
+    return struct.pack(">i", len(raw)) + _pad4(raw)
+
+
+def _enc_attrs(attrs: Dict[str, AttrValue]) -> bytes:
+    if not attrs:
+        return struct.pack(">ii", 0, 0)
+    out = [struct.pack(">ii", _NC_ATTRIBUTE, len(attrs))]
+    for name, value in attrs.items():
+        if isinstance(value, str):
+            raw = value.encode("utf-8")
+            out.append(_enc_name(name) + struct.pack(">ii", 2, len(raw)) + _pad4(raw))
+            continue
+        if isinstance(value, float):
+            arr = np.asarray([value], dtype=np.float64)
+        elif isinstance(value, int):
+            arr = np.asarray([value], dtype=np.int32)
+        else:
+            arr = np.atleast_1d(np.asarray(value))
+        t = _nc_type(arr.dtype)
+        raw = arr.astype(np.dtype(_NC_TYPES[t])).tobytes()
+        out.append(_enc_name(name) + struct.pack(">ii", t, arr.size) + _pad4(raw))
+    return b"".join(out)
+
+
+def _encode_header(version: int, numrecs: int, dims: List[Tuple[str, int]], attrs: Dict[str, AttrValue],
+                   variables: List[Tuple[str, List[str], np.dtype, Dict[str, AttrValue], int, int]]) -> bytes:
+    """`variables` as (name, dim names, dtype, attrs, vsize, begin); CDF1 or CDF2."""
+    if version not in (1, 2):
+        raise ValueError(f"Cannot encode a CDF{version} header")
+    dim_ids = {name: i for i, (name, _) in enumerate(dims)}
+    h = [b"CDF" + bytes([version]), struct.pack(">i", numrecs)]
+    h.append(struct.pack(">ii", _NC_DIMENSION, len(dims)) if dims else struct.pack(">ii", 0, 0))
+    for name, size in dims:
+        h.append(_enc_name(name) + struct.pack(">i", size))
+    h.append(_enc_attrs(attrs))
+    h.append(struct.pack(">ii", _NC_VARIABLE, len(variables)) if variables else struct.pack(">ii", 0, 0))
+    for name, vdims, dtype, vattrs, vsize, begin in variables:
+        h.append(_enc_name(name) + struct.pack(">i", len(vdims)))
+        h.append(b"".join(struct.pack(">i", dim_ids[d]) for d in vdims))
+        h.append(_enc_attrs(vattrs))
+        h.append(struct.pack(">ii", _nc_type(dtype), min(vsize, 2**32 - 4)))
+        h.append(struct.pack(">q" if version == 2 else ">i", begin))
+    return b"".join(h)
+
+
+def write_classic(path: Path, dims: List[Tuple[str, int]], attrs: Dict[str, AttrValue],
+                  variables: List[Tuple[str, List[str], np.ndarray, Dict[str, AttrValue]]],
+                  header_pad: int = 0) -> None:
+    """
+    Write a CDF2 file. `dims` as (name, size) with size 0 for the record
+    dimension; `variables` as (name, dim names, data, attrs). Data are stored
+    in their own dtype (big-endian on disk). Written to a .part file first.
+    `header_pad` bytes are left free after the header so that update_header()
+    can later grow the attributes in place.
+    """
+    rec_dim = next((n for n, s in dims if s == 0), None)
+    numrecs = 0
+
+    layout = []   # (name, vdims, big-endian data, attrs, is_record, vsize)
+    for name, vdims, data, vattrs in variables:
+        t = _nc_type(data.dtype)
+        arr = np.ascontiguousarray(data, dtype=np.dtype(_NC_TYPES[t]))
+        is_record = bool(vdims) and vdims[0] == rec_dim
+        if is_record:
+            numrecs = max(numrecs, arr.shape[0])
+            slab = int(np.prod(arr.shape[1:], dtype=np.int64)) * arr.dtype.itemsize
+        else:
+            slab = arr.nbytes
+        layout.append((name, vdims, arr, vattrs, is_record, slab + (-slab % 4)))
+
+    def header(begins: List[int]) -> bytes:
+        return _encode_header(2, numrecs, dims, attrs,
+                              [(name, vdims, arr.dtype, vattrs, vsize, begin)
+                               for (name, vdims, arr, vattrs, _, vsize), begin in zip(layout, begins)])
+
+    pos = len(header([0] * len(layout))) + header_pad
+    pos += -pos % 4
+    begins: List[int] = [0] * len(layout)
+    for i, (_, _, _, _, is_record, vsize) in enumerate(layout):
+        if not is_record:
+            begins[i] = pos
+            pos += vsize
+    rec_idx = [i for i, ent in enumerate(layout) if ent[4]]
+    for i in rec_idx:
+        begins[i] = pos
+        # a single record variable is not padded inside the record
+        pos += layout[i][2][0].nbytes if len(rec_idx) == 1 and numrecs else layout[i][5]
+
+    target = Path(path)
+    tmp = target.with_name(target.name + ".part")
+    with open(tmp, "wb") as f:
+        head = header(begins)
+        f.write(head + b"\x00" * (min(begins, default=len(head)) - len(head)))
+        for _, _, arr, _, is_record, vsize in layout:
+            if not is_record:
+                f.write(_pad4(arr.tobytes()))
+        for r in range(numrecs):
+            for i in rec_idx:
+                arr, vsize = layout[i][2], layout[i][5]
+                raw = arr[r:r + 1].tobytes() if r < arr.shape[0] else b"\x00" * vsize
+                f.write(raw if len(rec_idx) == 1 else raw + b"\x00" * (vsize - len(raw)))
+    tmp.replace(target)
+
+
+# ==========================================
+# In-place updates (appending records, header attributes)
+# ============================================================
+def update_header(path: Path, attrs: Optional[Dict[str, AttrValue]] = None,
+                  numrecs: Optional[int] = None) -> None:
+    """
+    Rewrite the header of an existing file with new global attributes and/or
+    record count, leaving all data where it is. Raises ValueError if the new
+    header does not fit in front of the first variable (see header_pad).
+    """
+    h = read_header(path)
+    variables = list(h.variables.values())
+    head = _encode_header(h.version, h.numrecs if numrecs is None else numrecs, h.dims,
+                          h.attrs if attrs is None else attrs,
+                          [(v.name, v.dims, v.dtype, v.attrs, v.vsize, v.begin) for v in variables])
+    first = min((v.begin for v in variables), default=len(head))
+    if len(head) > first:
+        raise ValueError(f"New header ({len(head)} bytes) does not fit before the data at {first}")
+    with open(path, "r+b") as f:
+        f.write(head + b"\x00" * (first - len(head)))
+        f.flush()
+        os.fsync(f.fileno())
+    # same size, and the mtime may not have moved on coarse filesystems
+    _cached_header.cache_clear()
+
+
+def append_records(path: Path, records: Dict[str, np.ndarray],
+                   attrs: Optional[Dict[str, AttrValue]] = None) -> int:
+    """
+    Append records to the record dimension of an existing file. `records`
+    holds every record variable, already packed in its file dtype, with the
+    same number of new records. Record data are written and synced first and
+    numrecs (plus new global `attrs`, if given) is written last, so an
+    interrupted append leaves the file as it was (readers ignore bytes past
+    numrecs). Returns the new record count.
+    """
+    h = read_header(path)
+    if h.version not in (1, 2):
+        raise ValueError(f"Cannot append to a CDF{h.version} file")
+    rec_vars = [v for v in h.variables.values() if v.is_record]
+    if sorted(records) != sorted(v.name for v in rec_vars):
+        raise ValueError("append_records needs exactly the record variables "
+                         f"{', '.join(v.name for v in rec_vars)}")
+    n = {records[v.name].shape[0] for v in rec_vars}
+    if len(n) != 1:
+        raise ValueError("All record variables need the same number of new records")
+    n_new = n.pop()
+    with open(path, "r+b") as f:
+        for v in rec_vars:
+            arr = np.ascontiguousarray(records[v.name], dtype=v.dtype)
+            if arr.shape[1:] != v.shape[1:]:
+                raise ValueError(f"{v.name}: record shape {arr.shape[1:]} != {v.shape[1:]}")
+            for k in range(n_new):
+                f.seek(v.begin + (h.numrecs + k) * h.recsize)
+                f.write(arr[k:k + 1].tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    if attrs is not None:
+        update_header(path, attrs=attrs, numrecs=h.numrecs + n_new)
+        return h.numrecs + n_new
+    with open(path, "r+b") as f:
+        # numrecs: 4 bytes after the magic in CDF1/CDF2
+        f.seek(4)
+        f.write(struct.pack(">i", h.numrecs + n_new))
+        f.flush()
+        os.fsync(f.fileno())
+    _cached_header.cache_clear()
+    return h.numrecs + n_new
+
+
+def pack(values: np.ndarray, attrs: Dict[str, AttrValue], dtype: np.dtype) -> np.ndarray:
+    """Inverse of Var.unpack(): float values -> `dtype` using scale/offset/fill from `attrs`."""
+    if dtype.kind == "f":
+        return values.astype(dtype)
+    scale = float(attrs.get("scale_factor", 1.0))
+    offset = float(attrs.get("add_offset", 0.0))
+    fill = attrs.get("_FillValue", attrs.get("missing_value"))
+    info = np.iinfo(dtype)
+    packed = np.clip(np.round((values - offset) / scale), info.min + 1, info.max)
+    if fill is not None:
+        packed = np.where(np.isfinite(values), packed, fill)
+    return packed.astype(dtype)
+
+
+def copy_header_vars(nc: ClassicFile) -> List[Tuple[str, List[str], Dict[str, AttrValue]]]:
+    """(name, dims, attrs) of every variable, in file order, for rewriting a file."""
+    return [(v.name, v.dims, dict(v.attrs)) for v in nc.variables.values()]
+# %%
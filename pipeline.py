@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# ============================================================
+# Post-download stage pipeline
+# ============================================================
+# Downloads hand finished files to the pipeline and go straight on to the
+# next MARS request; the registered stages run in a small thread pool while
+# the next transfer is in flight, so a run takes ~max(download, processing)
+# instead of their sum.
+#
+# - Stages run in the configured order for each file. A required stage
+#   (verify) that raises stops that file only: later stages are skipped and
+#   the item is handed back by take_failed(). Any other stage that raises is
+#   logged and the file carries on through the remaining stages.
+# - Stages marked in_process=True run their callable in a process pool
+#   (CPU-heavy NumPy work, "forkserver" workers); the callable must then be a
+#   picklable module level function taking the file path (use
+#   functools.partial for args).
+# - submit() blocks once MAX_PENDING files are in the pipeline (back-pressure),
+#   so a slow stage throttles downloads instead of piling up work.
+# - Per-stage timings are logged by close().
+
+PIPELINE_WORKERS = 2
+PROCESS_WORKERS = 4
+MAX_PENDING = 4
+
+
+class Item:
+    """One downloaded file travelling through the stages."""
+
+    def __init__(self, path: Path, **meta: object) -> None:
+        self.path = path
+        self.meta = meta
+        self.failed_stage: Optional[str] = None
+        self.error: Optional[str] = None
+        self.stage_errors: Dict[str, str] = {}   # non-required stages that failed
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable, in_process: bool = False, required: bool = False) -> None:
+        self.name = name
+        self.fn = fn
+        self.in_process = in_process
+        self.required = required
+
+
+# name -> factory building the Stage; see register_stage()
+STAGES: Dict[str, Callable[..., Stage]] = {}
+
+
+def register_stage(name: str):
+    """Decorator registering a Stage factory under `name`."""
+    def deco(factory: Callable[..., Stage]) -> Callable[..., Stage]:
+        STAGES[name] = factory
+        return factory
+    return deco
+
+
+def build_stages(names: List[str], **kwargs: object) -> List[Stage]:
+    unknown = [n for n in names if n not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown pipeline stage(s): {', '.join(unknown)}")
+    return [STAGES[n](**kwargs) for n in names]
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], logger: logging.Logger,
+                 workers: int = PIPELINE_WORKERS, max_pending: int = MAX_PENDING,
+                 process_workers: int = PROCESS_WORKERS) -> None:
+        self.stages = stages
+        self.logger = logger
+        self.threads = ThreadPoolExecutor(max_workers=workers)
+        # forkserver, not fork: workers are started while stage threads may
+        # hold locks (stations.py, publisher.py), which a forked child would keep
+        self.procs = (ProcessPoolExecutor(max_workers=process_workers,
+                                          mp_context=multiprocessing.get_context("forkserver"))
+                      if any(s.in_process for s in stages) else None)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.timings: Dict[str, List[float]] = {s.name: [0, 0.0, 0.0] for s in stages}  # n, total, max
+        self.active = 0
+        self.failed: List[Item] = []
+
+    def submit(self, item: Item) -> None:
+        self.slots.acquire()
+        with self.lock:
+            self.active += 1
+        self.threads.submit(self._run, item)
+
+    def _run(self, item: Item) -> None:
+        try:
+            for stage in self.stages:
+                t0 = time.time()
+                try:
+                    if stage.in_process:
+                        self.procs.submit(stage.fn, item.path).result()
+                    else:
+                        stage.fn(item)
+                except Exception as e:
+                    if not stage.required:
+                        item.stage_errors[stage.name] = str(e)
+                        self.logger.error(f"Stage {stage.name} FAILED for {item.name}: {e} (continuing)")
+                        continue
+                    item.failed_stage = stage.name
+                    item.error = str(e)
+                    self.logger.error(f"Stage {stage.name} FAILED for {item.name}: {e}")
+                    with self.lock:
+                        self.failed.append(item)
+                    return
+                finally:
+                    self._time(stage.name, time.time() - t0)
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def take_failed(self) -> List[Item]:
+        """Items stopped by a required stage since the last call."""
+        with self.lock:
+            out, self.failed = self.failed, []
+        return out
+
+    def drain(self) -> None:
+        """Wait until every submitted file has been through the stages (the pipeline stays open)."""
+        with self.lock:
+            while self.active:
+                self.idle.wait()
+
+    def _time(self, name: str, secs: float) -> None:
+        with self.lock:
+            t = self.timings[name]
+            t[0] += 1
+            t[1] += secs
+            t[2] = max(t[2], secs)
+
+    def close(self) -> List[Item]:
+        """Wait for all files, log per-stage timings, return the failed items not yet taken."""
+        self.threads.shutdown(wait=True)
+        if self.procs is not None:
+            self.procs.shutdown(wait=True)
+        for name, (n, total, mx) in self.timings.items():
+            if n:
+                self.logger.info(f"Stage {name}: n={int(n)} total={total:.1f} s max={mx:.1f} s")
+        return self.take_failed()
+# %%
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import datetime as dt
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+# ============================================================
+# Incremental delta publisher for downstream mirrors
+# ============================================================
+# Every file the download scripts rename into place is appended to a change
+# feed DOWNLOAD_ROOT/FEED_NAME, one JSON object per line:
+#   {"seq": 42, "path": "EUROPE/icki/.../16_01_2026-16_01_2026.nc",
+#    "size": 3387576, "sha256": "...", "ts": "2026-01-19T08:15:28+00:00"}
+# Files that retention.py removes get a tombstone instead
+#   {"seq": 43, "path": "...", "deleted": true, "ts": "..."}
+# (a compressed window is its .nc.gz entry plus a tombstone for the .nc).
+# A mirror remembers the last seq and byte offset it applied, so each pull
+# reads only the tail of the feed and fetches only the files listed there;
+# tombstoned paths are removed from the mirror.
+#
+# Usage:
+#   python publisher.py serve [PORT]            # HTTP transport (Range-aware)
+#   python publisher.py pull SOURCE DEST        # SOURCE = http://host:port/ or a directory
+
+DOWNLOAD_ROOT = Path("/home/agkiokas/MARS/data/")
+FEED_NAME = "changes.jsonl"
+STATE_NAME = ".mirror_state.json"
+
+SERVE_PORT = 8765
+PULL_WORKERS = 4
+CHUNK = 1024 * 1024
+
+_feed_lock = threading.Lock()
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _parse_entry(line: bytes) -> Optional[Dict[str, object]]:
+    """One feed line, or None for a line torn by a crash mid-write."""
+    try:
+        e = json.loads(line)
+        int(e["seq"])
+        str(e["path"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    return e
+
+
+def _last_seq(f: BinaryIO) -> int:
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    start = end
+    while start > 0:
+        start = max(0, start - 4096)
+        f.seek(start)
+        lines = f.read(end - start).split(b"\n")
+        # the first line may be cut by the block boundary, unless it starts the file
+        for line in reversed(lines if start == 0 else lines[1:]):
+            e = _parse_entry(line) if line.strip() else None
+            if e is not None:
+                return int(e["seq"])
+    return 0
+
+
+def _append(root: Path, rec: Dict[str, object]) -> int:
+    # threads: _feed_lock; processes: a lockf lock on the whole feed, which
+    # (unlike flock) is not inherited by a child forked while it is held
+    with _feed_lock, open(root / FEED_NAME, "a+b") as f:
+        fcntl.lockf(f, fcntl.LOCK_EX, 0, 0, os.SEEK_SET)
+        try:
+            seq = _last_seq(f) + 1
+            line = json.dumps({"seq": seq, **rec}, sort_keys=True) + "\n"
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # keep a torn last line on a line of its own
+                    line = "\n" + line
+            f.write(line.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN, 0, 0, os.SEEK_SET)
+    return seq
+
+
+def _now() -> str:
+    return dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+
+
+def publish_change(root: Path, path: Path) -> int:
+    """Append `path` to the change feed; returns its sequence number."""
+    return _append(root, {
+        "path": str(path.relative_to(root)),
+        "size": path.stat().st_size,
+        "sha256": sha256_file(path),
+        "ts": _now(),
+    })
+
+
+def publish_removal(root: Path, path: Path) -> int:
+    """Append a tombstone for `path` (no longer on disk) to the change feed."""
+    return _append(root, {"path": str(path.relative_to(root)), "deleted": True, "ts": _now()})
+
+
+# ==========================================
+# HTTP transport
+# ============================================================
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Static files plus 'Range: bytes=N-' so mirrors can read the feed tail."""
+
+    def send_head(self):
+        rng = self.headers.get("Range")
+        if not rng or not rng.startswith("bytes="):
+            return super().send_head()
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return None
+        start = int(rng[len("bytes="):].split("-", 1)[0] or 0)
+        size = path.stat().st_size
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return f
+
+
+def serve(root: Path, port: int) -> None:
+    httpd = ThreadingHTTPServer(("", port), partial(RangeHandler, directory=str(root)))
+    print(f"Serving {root} on port {port}")
+    httpd.serve_forever()
+
+
+# ==========================================
+# Pull client
+# ============================================================
+def _is_url(source: str) -> bool:
+    return source.startswith(("http://", "https://"))
+
+
+def _open_source(source: str, rel: str, offset: int = 0) -> BinaryIO:
+    if _is_url(source):
+        req = urllib.request.Request(source.rstrip("/") + "/" + urllib.parse.quote(rel))
+        if offset:
+            req.add_header("Range", f"bytes={offset}-")
+        try:
+            return urllib.request.urlopen(req, timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code == 416:   # nothing new after offset
+                return open(os.devnull, "rb")
+            raise
+    f = open(Path(source) / rel, "rb")
+    f.seek(offset)
+    return f
+
+
+def read_feed_tail(source: str, offset: int) -> List[Tuple[Dict[str, object], int]]:
+    """(entry, byte offset just after its line) for each complete new line."""
+    with _open_source(source, FEED_NAME, offset) as f:
+        data = f.read()
+    out = []
+    pos = offset
+    for line in data.split(b"\n")[:-1]:   # a trailing partial line is left for next time
+        pos += len(line) + 1
+        e = _parse_entry(line) if line.strip() else None
+        if e is not None:
+            out.append((e, pos))
+    return out
+
+
+def fetch_one(source: str, dest: Path, entry: Dict[str, object]) -> None:
+    rel = str(entry["path"])
+    target = dest / rel
+    if entry.get("deleted"):
+        target.unlink(missing_ok=True)
+        return
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists() and target.stat().st_size == entry["size"] and sha256_file(target) == entry["sha256"]:
+        return
+    tmp = target.with_name(target.name + ".part")
+    h = hashlib.sha256()
+    with _open_source(source, rel) as src, open(tmp, "wb") as dst:
+        for block in iter(lambda: src.read(CHUNK), b""):
+            h.update(block)
+            dst.write(block)
+    if h.hexdigest() != entry["sha256"]:
+        tmp.unlink(missing_ok=True)
+        raise RuntimeError(f"Checksum mismatch for {rel}")
+    tmp.replace(target)
+
+
+def _load_state(dest: Path) -> Dict[str, int]:
+    p = dest / STATE_NAME
+    if p.exists():
+        return json.loads(p.read_text(encoding="utf-8"))
+    return {"seq": 0, "offset": 0}
+
+
+def _save_state(dest: Path, state: Dict[str, int]) -> None:
+    p = dest / STATE_NAME
+    tmp = p.with_name(p.name + ".part")
+    tmp.write_text(json.dumps(state), encoding="utf-8")
+    tmp.replace(p)
+
+
+def pull(source: str, dest: Path, logger: logging.Logger, workers: int = PULL_WORKERS) -> int:
+    dest.mkdir(parents=True, exist_ok=True)
+    state = _load_state(dest)
+    entries = [(e, off) for e, off in read_feed_tail(source, state["offset"]) if int(e["seq"]) > state["seq"]]
+    if not entries:
+        logger.info(f"Up to date at seq {state['seq']}")
+        return 0
+
+    # only the latest entry per path matters: a file that was compressed or
+    # deleted after it was published is settled by its tombstone, not fetched
+    latest: Dict[str, Dict[str, object]] = {}
+    for e, _ in entries:
+        latest[str(e["path"])] = e
+
+    failed: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futs = {pool.submit(fetch_one, source, dest, e): p for p, e in latest.items()}
+        for fut, p in futs.items():
+            try:
+                fut.result()
+            except Exception as ex:
+                failed[p] = str(ex)
+                logger.error(f"FAILED {p}: {ex}")
+
+    # advance the cursor up to (not past) the first entry that failed
+    for e, off in entries:
+        if str(e["path"]) in failed:
+            break
+        state = {"seq": int(e["seq"]), "offset": off}
+    _save_state(dest, state)
+    removed = sum(1 for e in latest.values() if e.get("deleted"))
+    logger.info(f"Pulled {len(latest) - removed - len(failed)} file(s), removed {removed}, "
+                f"{len(failed)} failed, now at seq {state['seq']}")
+    return 2 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    if args and args[0] == "serve":
+        serve(DOWNLOAD_ROOT, int(args[1]) if len(args) > 1 else SERVE_PORT)
+        return 0
+    if len(args) == 3 and args[0] == "pull":
+        return pull(args[1], Path(args[2]), logging.getLogger("cams_mirror"))
+    print("usage: publisher.py serve [PORT] | pull SOURCE DEST", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
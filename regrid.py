@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from nc_classic import copy_header_vars, open_classic, pack, write_classic
+
+# ============================================================
+# Local multi-resolution regridding from one native download
+# ============================================================
+# The window is downloaded once at the finest grid (GRID in auto_download.py)
+# and every coarser grid in DERIVED_GRIDS is produced locally:
+#   <run_dir>/<label>.nc                       native download
+#   <run_dir>/grid_<dlat>x<dlon>/<label>.nc    derived, e.g. grid_0p8x0p8
+# Both methods are separable linear operators (one weight matrix per axis),
+# so a whole (time, lat, lon) variable is regridded with two matmuls:
+#   conservative : area-weighted (cos lat) average of the fine cells each
+#                  coarse cell overlaps; needs aligned grids (check_aligned)
+#   bilinear     : linear interpolation along each axis
+# Every window of a profile shares the same axes, so the weight matrices are
+# what repeats: they are kept in a small in-process LRU (WEIGHT_CACHE_SIZE).
+# A derived file is rebuilt whenever its source is newer (e.g. after a top-up)
+# and is counted with its window in the archive index (archive_index.window_files).
+
+METHODS = ("conservative", "bilinear")
+WEIGHT_CACHE_SIZE = 8
+
+_weights: "OrderedDict[tuple, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+
+
+def grid_tag(grid: Tuple[float, float]) -> str:
+    return "x".join(f"{g:g}".replace(".", "p") for g in grid)
+
+
+def derived_path(nc_path: Path, grid: Tuple[float, float]) -> Path:
+    return nc_path.parent / f"grid_{grid_tag(grid)}" / nc_path.name
+
+
+def _is_multiple(a: float, b: float) -> bool:
+    r = a / b
+    return abs(r - round(r)) < 1e-6 and round(r) >= 1
+
+
+def check_aligned(fine: Tuple[float, float], coarse: Tuple[float, float],
+                  area: Tuple[float, float, float, float]) -> Tuple[int, int]:
+    """
+    fine/coarse as from _parse_grid(), area as from _parse_area().
+    The coarse spacing must be an integer multiple of the fine one, so that
+    (starting from the N/W corner) every coarse point is also a fine point,
+    and the area must hold at least two coarse points per axis.
+    Returns the (lat, lon) refinement factors.
+    """
+    n, w, s, e = area
+    for axis, f, c, extent in (("lat", fine[0], coarse[0], abs(n - s)), ("lon", fine[1], coarse[1], abs(e - w))):
+        if not _is_multiple(c, f):
+            raise ValueError(f"{axis}: target spacing {c} is not a multiple of source spacing {f}")
+        if extent < c:
+            raise ValueError(f"{axis}: area extent {extent} is smaller than target spacing {c}")
+    return int(round(coarse[0] / fine[0])), int(round(coarse[1] / fine[1]))
+
+
+# ==========================================
+# Weight matrices
+# ============================================================
+def _target_axis(src: np.ndarray, step: float) -> np.ndarray:
+    sign = 1.0 if src[-1] >= src[0] else -1.0
+    n = int(np.floor(abs(src[-1] - src[0]) / step + 1e-6)) + 1
+    return src[0] + sign * step * np.arange(n)
+
+
+def conservative_weights(src: np.ndarray, dst: np.ndarray, src_step: float, dst_step: float,
+                         coslat: bool = False) -> np.ndarray:
+    """W[k, i] = overlap of fine cell i with coarse cell k (cos-lat weighted)."""
+    s_lo, s_hi = src - src_step / 2, src + src_step / 2
+    d_lo, d_hi = dst - dst_step / 2, dst + dst_step / 2
+    overlap = np.clip(np.minimum(d_hi[:, None], s_hi[None, :]) - np.maximum(d_lo[:, None], s_lo[None, :]), 0, None)
+    if coslat:
+        overlap = overlap * np.cos(np.deg2rad(src))[None, :]
+    return overlap
+
+
+def bilinear_weights(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    order = np.argsort(src)
+    xs = src[order]
+    j = np.clip(np.searchsorted(xs, dst) - 1, 0, len(xs) - 2)
+    t = np.clip((dst - xs[j]) / (xs[j + 1] - xs[j]), 0.0, 1.0)
+    W = np.zeros((len(dst), len(src)))
+    rows = np.arange(len(dst))
+    W[rows, order[j]] = 1 - t
+    W[rows, order[j + 1]] += t
+    return W
+
+
+def apply_weights(data: np.ndarray, W_lat: np.ndarray, W_lon: np.ndarray) -> np.ndarray:
+    """(..., lat, lon) -> (..., lat', lon'), NaNs excluded and weights renormalised."""
+    valid = np.isfinite(data)
+    num = W_lat @ np.where(valid, data, 0.0) @ W_lon.T
+    den = W_lat @ valid.astype(np.float64) @ W_lon.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(den > 0, num / den, np.nan)
+
+
+def _cached_weights(lat: np.ndarray, lon: np.ndarray, new_lat: np.ndarray, new_lon: np.ndarray,
+                    src_step: Tuple[float, float], grid: Tuple[float, float],
+                    method: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(W_lat, W_lon) for these axes, from the LRU when another window had the same ones."""
+    key = (lat.tobytes(), lon.tobytes(), src_step, grid, method)
+    if key in _weights:
+        _weights.move_to_end(key)
+        return _weights[key]
+    if method == "conservative":
+        check_aligned(src_step, grid, (lat[0], lon[0], lat[-1], lon[-1]))
+        W = (conservative_weights(lat, new_lat, src_step[0], grid[0], coslat=True),
+             conservative_weights(lon, new_lon, src_step[1], grid[1]))
+    else:
+        W = (bilinear_weights(lat, new_lat), bilinear_weights(lon, new_lon))
+    _weights[key] = W
+    while len(_weights) > WEIGHT_CACHE_SIZE:
+        _weights.popitem(last=False)
+    return W
+
+
+# ==========================================
+# One file
+# ============================================================
+def regrid_file(src: Path, dst: Path, grid: Tuple[float, float], method: str,
+                lat_name: str = "latitude", lon_name: str = "longitude") -> Path:
+    if method not in METHODS:
+        raise ValueError(f"Unknown regrid method {method!r}")
+    nc = open_classic(src)
+    lat = nc.coord(lat_name)
+    lon = nc.coord(lon_name)
+    # coordinates are float32 on disk: take the spacing over the whole axis
+    src_step = (round(abs(lat[-1] - lat[0]) / (len(lat) - 1), 6),
+                round(abs(lon[-1] - lon[0]) / (len(lon) - 1), 6))
+    new_lat = _target_axis(lat, grid[0])
+    new_lon = _target_axis(lon, grid[1])
+    W_lat, W_lon = _cached_weights(lat, lon, new_lat, new_lon, src_step, grid, method)
+
+    dims = [(name, len(new_lat) if name == lat_name else len(new_lon) if name == lon_name else size)
+            for name, size in nc.header.dims]
+    out_vars = []
+    for name, vdims, attrs in copy_header_vars(nc):
+        v = nc[name]
+        if name == lat_name:
+            data = new_lat.astype(v.info.dtype)
+        elif name == lon_name:
+            data = new_lon.astype(v.info.dtype)
+        elif vdims[-2:] == [lat_name, lon_name]:
+            data = pack(apply_weights(v[...].astype(np.float64), W_lat, W_lon), attrs, v.info.dtype)
+        else:
+            data = np.asarray(v.raw)
+        out_vars.append((name, vdims, data, attrs))
+
+    attrs = dict(nc.attrs)
+    attrs["history"] = f"{attrs.get('history', '')}\nregrid.py: {method} to {grid[0]:g}/{grid[1]:g}".strip()
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    write_classic(dst, dims, attrs, out_vars)
+    return dst
+
+
+def derive(src: Path, grid: Tuple[float, float], method: str) -> Path:
+    """Produce derived_path(src, grid) unless it is already newer than `src`."""
+    dst = derived_path(src, grid)
+    if dst.exists() and dst.stat().st_mtime_ns >= src.stat().st_mtime_ns:
+        return dst
+    return regrid_file(src, dst, grid, method)
+
+
+def derive_all(src: Path, grids: List[Tuple[float, float]], method: str) -> List[Path]:
+    """All derived grids of one window (one pipeline stage call)."""
+    return [derive(src, g, method) for g in grids]
+# %%
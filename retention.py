@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import datetime as dt
+import fcntl
+import gzip
+import logging
+import shutil
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from archive_index import (DOWNLOAD_ROOT, SUMMARY_SUFFIX, TIERS, disk_usage, open_index, window_bytes,
+                           window_files)
+from publisher import publish_change, publish_removal
+from topup import TOPUP_SUFFIX
+
+# ============================================================
+# Disk-budget retention / tiered storage
+# ============================================================
+# Files move one way through the tiers of archive_index.TIERS:
+#   full        -> the .nc as downloaded
+#   compressed  -> gzip'ed to .nc.gz
+#   summary     -> data and derived grids removed, only the .summary.npz
+#                  (daily_summaries.py) is kept
+#   deleted     -> everything removed
+# The row stays in the index: auto_download.py skips any window whose tier is
+# past 'full' instead of fetching it again.
+# Age rules (days since run date) are always applied; if the archive is still
+# above DISK_BUDGET_BYTES, the oldest files are pushed one tier further until
+# the budget is met (windows without a summary go from compressed straight to
+# deleted). Usage is the index's per-window sizes plus the shared products
+# (archive_index.disk_usage); the window tree itself is never walked.
+# Every data file that is compressed or removed is also recorded in the
+# mirrors' change feed (publisher.py): the new .nc.gz, and a tombstone for
+# each .nc / .nc.gz that is gone.
+#
+# Usage:
+#   python retention.py            # one incremental pass
+#   python retention.py --dry-run  # log what would be done
+
+# Per-profile rules ("REGNAME/EXPVER/TYPE/LEVTYPE"); None disables a step.
+#   compress_days : gzip full files older than this
+#   freshest_days : keep only the freshest forecast per valid date (others -> summary)
+#   summary_days  : keep only summaries
+#   delete_days   : delete everything
+DEFAULT_RULE: Dict[str, Optional[int]] = {
+    "compress_days": 30,
+    "freshest_days": 90,
+    "summary_days": 365,
+    "delete_days": None,
+}
+RETENTION_RULES: Dict[str, Dict[str, Optional[int]]] = {
+    "EUROPE/icki/FC/SFC": dict(DEFAULT_RULE),
+    "GLOBE/0001/FC/ML": {"compress_days": 14, "freshest_days": 30, "summary_days": 90, "delete_days": 365},
+}
+
+DISK_BUDGET_BYTES: Optional[int] = 200 * 1024**3   # None = age rules only
+MIN_KEEP_DAYS = 7            # never touch run dates younger than this, even over budget
+MAX_ACTIONS_PER_RUN = 500    # incremental: bounded work per invocation
+SETTLE_SECONDS = 15 * 60     # skip files modified recently (may still be in use)
+PUBLISH_CHANGES = True       # same switch as in auto_download.py
+
+LOCK_NAME = ".retention.lock"
+LOG_NAME = "retention.log"
+
+
+def setup_logger(log_path: Path) -> logging.Logger:
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    logger = logging.getLogger("cams_retention")
+    logger.setLevel(logging.INFO)
+    logger.handlers.clear()
+
+    fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+    fh = logging.FileHandler(log_path, encoding="utf-8")
+    fh.setFormatter(fmt)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(fmt)
+    logger.addHandler(fh)
+    logger.addHandler(sh)
+    return logger
+
+
+def _age_days(run_date: str, today: dt.date) -> int:
+    return (today - dt.datetime.strptime(run_date, "%Y%m%d").date()).days
+
+
+def _rule(profile: str) -> Dict[str, Optional[int]]:
+    return RETENTION_RULES.get(profile, DEFAULT_RULE)
+
+
+def _summary(nc: Path) -> Path:
+    return nc.with_name(nc.stem + SUMMARY_SUFFIX)
+
+
+def _busy(nc: Path) -> bool:
+    """A download (.part), a pending top-up or a recent write on this window: leave it alone."""
+    for suffix in (".part", TOPUP_SUFFIX, TOPUP_SUFFIX + ".part"):
+        if nc.with_name(nc.name + suffix).exists():
+            return True
+    return nc.exists() and time.time() - nc.stat().st_mtime < SETTLE_SECONDS
+
+
+class Retention:
+    def __init__(self, root: Path, conn: sqlite3.Connection, logger: logging.Logger,
+                 dry_run: bool = False) -> None:
+        self.root = root
+        self.conn = conn
+        self.logger = logger
+        self.dry_run = dry_run
+        self.actions = 0
+        self.today = dt.datetime.now(dt.timezone.utc).date()
+
+    # ---------- tier transitions ----------
+    def _set(self, path: str, tier: str) -> None:
+        size = window_bytes(self.root / path)
+        self.conn.execute("UPDATE files SET tier = ?, size = ? WHERE path = ?", (tier, size, path))
+        self.conn.commit()
+
+    def _publish(self, added: List[Path], removed: List[Path]) -> None:
+        if not PUBLISH_CHANGES:
+            return
+        try:
+            for p in added:
+                publish_change(self.root, p)
+            for p in removed:
+                publish_removal(self.root, p)
+        except Exception as e:
+            self.logger.warning(f"Could not record {', '.join(p.name for p in added + removed)} "
+                                f"in the change feed: {e}")
+
+    def advance(self, row: sqlite3.Row, target: str) -> bool:
+        """Move one index row to `target` tier. Returns True if something changed."""
+        if self.actions >= MAX_ACTIONS_PER_RUN:
+            return False
+        nc = self.root / row["path"]
+        if _busy(nc):
+            return False
+        gz = nc.with_name(nc.name + ".gz")
+        cur = row["tier"]
+        if TIERS.index(target) <= TIERS.index(cur):
+            return False
+
+        if target == "summary" and not _summary(nc).exists():
+            # nothing to fall back on: compress instead of dropping data
+            if cur != "full":
+                return False
+            target = "compressed"
+
+        self.logger.info(f"{'[dry-run] ' if self.dry_run else ''}{row['path']}: {cur} -> {target}")
+        self.actions += 1
+        if self.dry_run:
+            return True
+
+        if target == "compressed":
+            tmp = gz.with_name(gz.name + ".part")
+            with open(nc, "rb") as src, gzip.open(tmp, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            tmp.replace(gz)
+            nc.unlink()
+            self._set(row["path"], "compressed")
+            self._publish([gz], [nc])
+        elif target == "summary":
+            gone = [p for p in window_files(nc) if p != _summary(nc)]
+            for p in gone:
+                p.unlink()
+            self._set(row["path"], "summary")
+            self._publish([], [p for p in gone if p in (nc, gz)])
+        elif target == "deleted":
+            gone = window_files(nc)
+            for p in gone:
+                p.unlink()
+            self._set(row["path"], "deleted")
+            self._publish([], [p for p in gone if p in (nc, gz)])
+        return True
+
+    # ---------- passes ----------
+    def _candidates(self, profile: str, tiers: List[str], older_than: int):
+        cutoff = (self.today - dt.timedelta(days=older_than)).strftime("%Y%m%d")
+        q = ("SELECT * FROM files WHERE profile = ? AND run_date < ? AND tier IN (%s) "
+             "ORDER BY run_date" % ",".join("?" * len(tiers)))
+        return self.conn.execute(q, (profile, cutoff, *tiers)).fetchall()
+
+    def apply_age_rules(self) -> None:
+        profiles = [r[0] for r in self.conn.execute("SELECT DISTINCT profile FROM files")]
+        for profile in profiles:
+            rule = _rule(profile)
+            # harshest step first, so a file jumps straight to its final tier
+            if rule.get("delete_days") is not None:
+                for row in self._candidates(profile, ["full", "compressed", "summary"], rule["delete_days"]):
+                    self.advance(row, "deleted")
+            if rule.get("summary_days") is not None:
+                for row in self._candidates(profile, ["full", "compressed"], rule["summary_days"]):
+                    self.advance(row, "summary")
+            if rule.get("freshest_days") is not None:
+                self._drop_superseded(profile, rule["freshest_days"])
+            if rule.get("compress_days") is not None:
+                for row in self._candidates(profile, ["full"], rule["compress_days"]):
+                    self.advance(row, "compressed")
+
+    def _drop_superseded(self, profile: str, older_than: int) -> None:
+        cutoff = (self.today - dt.timedelta(days=older_than)).strftime("%Y%m%d")
+        rows = self.conn.execute(
+            "SELECT f.* FROM files f WHERE f.profile = ? AND f.run_date < ? "
+            "AND f.tier IN ('full', 'compressed') AND EXISTS ("
+            "  SELECT 1 FROM files g WHERE g.profile = f.profile AND g.valid_date = f.valid_date "
+            "  AND g.run_date > f.run_date AND g.tier IN ('full', 'compressed')) "
+            "ORDER BY f.run_date",
+            (profile, cutoff),
+        ).fetchall()
+        for row in rows:
+            self.advance(row, "summary")
+
+    def enforce_budget(self, budget: int) -> None:
+        used = disk_usage(self.conn, self.root)
+        if used <= budget:
+            return
+        self.logger.info(f"Over budget: {used / 1024**3:.2f} GiB used, budget {budget / 1024**3:.2f} GiB")
+        cutoff = (self.today - dt.timedelta(days=MIN_KEEP_DAYS)).strftime("%Y%m%d")
+        rows = self.conn.execute(
+            "SELECT * FROM files WHERE run_date < ? AND tier != 'deleted' ORDER BY run_date, path",
+            (cutoff,),
+        ).fetchall()
+        for row in rows:
+            if used <= budget or self.actions >= MAX_ACTIONS_PER_RUN:
+                break
+            before = row["size"]
+            nxt = TIERS[TIERS.index(row["tier"]) + 1]
+            no_summary = nxt == "summary" and not _summary(self.root / row["path"]).exists()
+            if no_summary:
+                # nothing to fall back on (e.g. model-level profiles): the data
+                # can only be dropped altogether
+                nxt = "deleted"
+            if not self.advance(row, nxt):
+                continue
+            if no_summary:
+                self.logger.warning(f"{row['path']}: no summary kept, deleted to meet the disk budget")
+            if not self.dry_run:
+                after = self.conn.execute("SELECT size FROM files WHERE path = ?", (row["path"],)).fetchone()[0]
+                used -= before - after
+        if used > budget:
+            self.logger.warning(f"Still over budget after this pass: {used / 1024**3:.2f} GiB")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    dry_run = "--dry-run" in args
+    root = DOWNLOAD_ROOT
+
+    logger = setup_logger(root / LOG_NAME)
+    lock_f = open(root / LOCK_NAME, "w")
+    try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.warning("Another retention pass is running; exiting.")
+        return 0
+
+    conn = open_index(root)
+    try:
+        r = Retention(root, conn, logger, dry_run=dry_run)
+        r.apply_age_rules()
+        if DISK_BUDGET_BYTES is not None:
+            r.enforce_budget(DISK_BUDGET_BYTES)
+        logger.info(f"Retention pass done: {r.actions} action(s), "
+                    f"{disk_usage(conn, root) / 1024**3:.2f} GiB in use")
+    finally:
+        conn.close()
+        lock_f.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
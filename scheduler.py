@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+# ============================================================
+# Priority queue in front of MARS submission
+# ============================================================
+# Jobs are only turned into MARS requests when popped, so anything pushed
+# later with a better class pre-empts every queued (not yet started) job
+# of a worse class.
+#
+# Classes (lower = more urgent):
+#   FRESH    newest run date; day 0 first, then the later windows
+#   BACKFILL older run dates that are still missing windows
+#   REPAIR   re-tries of failed jobs
+# Starvation protection: a non-empty class that has not been served for
+# STARVATION_LIMIT pops is served next, whatever is waiting above it.
+
+FRESH = 0
+BACKFILL = 1
+REPAIR = 2
+CLASS_NAMES = {FRESH: "fresh", BACKFILL: "backfill", REPAIR: "repair"}
+
+STARVATION_LIMIT = 8
+
+
+class Job:
+    def __init__(self, run_date: str, day_idx: int, klass: int, attempt: int = 0) -> None:
+        self.run_date = run_date
+        self.day_idx = day_idx
+        self.klass = klass
+        self.attempt = attempt
+
+    def key(self) -> Tuple[int, int]:
+        # newest run date first, then earliest window
+        return -int(self.run_date), self.day_idx
+
+    def __repr__(self) -> str:
+        return f"Job({self.run_date} day{self.day_idx} {CLASS_NAMES.get(self.klass, self.klass)})"
+
+
+class JobQueue:
+    def __init__(self, starvation_limit: int = STARVATION_LIMIT) -> None:
+        self.starvation_limit = starvation_limit
+        self._heaps: Dict[int, List[Tuple[Tuple[int, int], int, Job]]] = {}
+        self._last_served: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self._tick = 0
+
+    def __len__(self) -> int:
+        return sum(len(h) for h in self._heaps.values())
+
+    def push(self, job: Job) -> None:
+        heap = self._heaps.setdefault(job.klass, [])
+        if not heap:
+            # a class only starts ageing once it has something waiting
+            self._last_served[job.klass] = self._tick
+        heapq.heappush(heap, (job.key(), next(self._seq), job))
+
+    def retry(self, job: Job, max_attempts: int) -> bool:
+        """Re-queue a failed job as a REPAIR; False once it has used max_attempts."""
+        if job.attempt >= max_attempts:
+            return False
+        self.push(Job(job.run_date, job.day_idx, REPAIR, job.attempt + 1))
+        return True
+
+    def pop(self) -> Optional[Job]:
+        waiting = sorted(k for k, h in self._heaps.items() if h)
+        if not waiting:
+            return None
+        klass = waiting[0]
+        for k in waiting[1:]:
+            if self._tick - self._last_served[k] >= self.starvation_limit:
+                klass = k
+                break
+        self._tick += 1
+        self._last_served[klass] = self._tick
+        return heapq.heappop(self._heaps[klass])[2]
+# %%
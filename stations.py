@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import csv
+import datetime as dt
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from archive_index import DOWNLOAD_ROOT, parse_window_path
+from nc_classic import ClassicFile, nearest_index, open_classic
+
+# ============================================================
+# Station time series extracted at ingest
+# ============================================================
+# Station coordinates come from <root>/stations.csv (columns id,lat,lon;
+# extra columns ignored). For every distinct grid (i.e. AREA/GRID
+# combination) the nearest (lat_idx, lon_idx) of each station is computed
+# once and cached in
+#   <root>/station_series/_index/<grid key>.npz
+# Every ingested window appends one row per step, for all stations at once,
+# to a per-profile columnar table:
+#   <root>/station_series/<profile>/
+#       meta.json          stations, variables, committed row count, ingested files
+#       run_time.i8        int64 epoch seconds, (rows,)
+#       valid_time.i8      int64 epoch seconds, (rows,)
+#       <var>.f4           float32, (rows, stations), unpacked, NaN = missing
+# Columns are appended first and meta.json (nrows) is replaced last, so a
+# crash leaves at most an uncommitted tail that the next append truncates.
+# StationTable.history() reads one station through memmaps; no NetCDF is opened.
+#
+# Usage:
+#   python stations.py rebuild [ROOT]                # re-extract every window under ROOT
+#   python stations.py query PROFILE STATION [--all] # CSV to stdout, e.g. EUROPE/icki/FC/SFC
+
+STATIONS_CSV_NAME = "stations.csv"
+TABLE_DIR_NAME = "station_series"
+INDEX_DIR_NAME = "_index"
+META_NAME = "meta.json"
+LOCK_NAME = ".lock"
+
+# NetCDF variable names of the params we extract (207.210 / 209.210)
+STATION_VARS = ["aod550", "duaod550"]
+
+TIME_COLUMNS = ("run_time", "valid_time")
+
+_EPOCH = dt.datetime(1970, 1, 1)
+_UNIT_SECONDS = {"days": 86400, "hours": 3600, "minutes": 60, "seconds": 1}
+
+_append_lock = threading.Lock()
+_index_cache: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+
+class Stations:
+    def __init__(self, ids: List[str], lats: np.ndarray, lons: np.ndarray) -> None:
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def digest(self) -> str:
+        h = hashlib.sha256()
+        for sid, la, lo in zip(self.ids, self.lats, self.lons):
+            h.update(f"{sid},{la:.6f},{lo:.6f}\n".encode("utf-8"))
+        return h.hexdigest()[:16]
+
+
+def load_stations(path: Path) -> Stations:
+    ids: List[str] = []
+    lats: List[float] = []
+    lons: List[float] = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            ids.append(row["id"].strip())
+            lats.append(float(row["lat"]))
+            lons.append(float(row["lon"]))
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Duplicate station ids in {path}")
+    return Stations(ids, np.asarray(lats), np.asarray(lons))
+
+
+def table_dir(root: Path, profile: str) -> Path:
+    return root / TABLE_DIR_NAME / profile
+
+
+# ==========================================
+# Station -> grid index, cached per grid
+# ============================================================
+def grid_key(lat: np.ndarray, lon: np.ndarray) -> str:
+    return (f"lat{lat[0]:g}_{lat[-1]:g}_{len(lat)}_lon{lon[0]:g}_{lon[-1]:g}_{len(lon)}"
+            .replace("-", "m").replace(".", "p"))
+
+
+def _nearest_or_outside(axis: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """nearest_index(), but -1 for points more than half a cell outside the axis."""
+    idx = nearest_index(axis, values)
+    half = abs(float(axis[-1] - axis[0])) / max(len(axis) - 1, 1) / 2
+    lo, hi = min(axis[0], axis[-1]) - half, max(axis[0], axis[-1]) + half
+    return np.where((values >= lo) & (values <= hi), idx, -1)
+
+
+def station_index(nc: ClassicFile, stations: Stations, cache_root: Path,
+                  lat_name: str = "latitude", lon_name: str = "longitude") -> Tuple[np.ndarray, np.ndarray]:
+    """(lat_idx, lon_idx) per station for this file's grid; -1 = outside the area."""
+    lat = nc.coord(lat_name)
+    lon = nc.coord(lon_name)
+    key = f"{grid_key(lat, lon)}_{stations.digest()}"
+    hit = _index_cache.get(key)
+    if hit is not None:
+        return hit
+
+    path = cache_root / INDEX_DIR_NAME / f"{key}.npz"
+    if path.exists():
+        with np.load(path) as z:
+            hit = z["lat_idx"], z["lon_idx"]
+    else:
+        hit = _nearest_or_outside(lat, stations.lats), _nearest_or_outside(lon, stations.lons)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".part")
+        with open(tmp, "wb") as f:
+            np.savez(f, lat_idx=hit[0], lon_idx=hit[1])
+        tmp.replace(path)
+    _index_cache[key] = hit
+    return hit
+
+
+# ==========================================
+# Extraction
+# ============================================================
+def time_to_epoch(values: np.ndarray, units: str) -> np.ndarray:
+    """CF 'hours since 1900-01-01 00:00:00.0' style times -> int64 epoch seconds."""
+    unit, _, base = units.partition(" since ")
+    base_dt = dt.datetime.fromisoformat(base.strip())
+    offset = int((base_dt - _EPOCH).total_seconds())
+    return offset + np.asarray(values, dtype=np.int64) * _UNIT_SECONDS[unit.strip().lower()]
+
+
+def _run_epoch(root: Path, path: Path) -> int:
+    # <profile>/<YYYYMMDD>/<HH_MM_SS>/<label>.nc
+    parts = path.relative_to(root).parts
+    init = dt.datetime.strptime(parts[-3] + parts[-2], "%Y%m%d%H_%M_%S")
+    return int((init - _EPOCH).total_seconds())
+
+
+def extract_window(nc: ClassicFile, stations: Stations, cache_root: Path,
+                   variables: List[str]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """valid_time (step,) and {var: (step, station) float32} for one open file."""
+    ii, jj = station_index(nc, stations, cache_root)
+    inside = (ii >= 0) & (jj >= 0)
+    t = nc["time"]
+    valid = time_to_epoch(t.raw[:], str(t.info.attrs["units"]))
+    out: Dict[str, np.ndarray] = {}
+    for var in variables:
+        values = np.full((len(valid), len(stations)), np.nan, dtype=np.float32)
+        if var in nc:
+            v = nc[var]
+            # one fancy-indexing read per step: only the pages holding stations are touched
+            values[:, inside] = v.unpack(v.raw[:, ii[inside], jj[inside]])
+        out[var] = values
+    return valid, out
+
+
+# ==========================================
+# Columnar table
+# ============================================================
+def _column_path(tdir: Path, name: str) -> Path:
+    return tdir / (f"{name}.i8" if name in TIME_COLUMNS else f"{name}.f4")
+
+
+def _read_meta(tdir: Path) -> Optional[Dict[str, object]]:
+    p = tdir / META_NAME
+    return json.loads(p.read_text(encoding="utf-8")) if p.exists() else None
+
+
+def _write_meta(tdir: Path, meta: Dict[str, object]) -> None:
+    p = tdir / META_NAME
+    tmp = p.with_name(p.name + ".part")
+    tmp.write_text(json.dumps(meta), encoding="utf-8")
+    tmp.replace(p)
+
+
+def _new_meta(stations: Stations, variables: List[str]) -> Dict[str, object]:
+    return {
+        "stations": stations.ids,
+        "lat": stations.lats.tolist(),
+        "lon": stations.lons.tolist(),
+        "digest": stations.digest(),
+        "variables": variables,
+        "nrows": 0,
+        "files": {},
+    }
+
+
+def _append_columns(tdir: Path, meta: Dict[str, object], columns: Dict[str, np.ndarray]) -> None:
+    nrows = int(meta["nrows"])
+    nst = len(meta["stations"])
+    for name, arr in columns.items():
+        width = 8 if name in TIME_COLUMNS else 4 * nst
+        with open(_column_path(tdir, name), "ab") as f:
+            f.truncate(nrows * width)      # drop a tail left by an interrupted append
+            f.write(np.ascontiguousarray(arr).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def append_window(root: Path, path: Path, stations: Optional[Stations] = None,
+                  variables: Optional[List[str]] = None) -> int:
+    """
+    Append all steps of one window file (.nc or .nc.gz) to its profile's table.
+    Returns the number of rows added (0 if this exact file was already ingested).
+    """
+    nc_path = path.with_suffix("") if path.suffix == ".gz" else path
+    parsed = parse_window_path(root, nc_path)
+    if parsed is None:
+        raise ValueError(f"Not a window file under {root}: {path}")
+    profile = parsed[0]
+    rel = str(nc_path.relative_to(root))
+    st = path.stat()
+    stamp = [st.st_size, st.st_mtime_ns]
+
+    stations = stations if stations is not None else load_stations(root / STATIONS_CSV_NAME)
+    tdir = table_dir(root, profile)
+    tdir.mkdir(parents=True, exist_ok=True)
+
+    # threads: _append_lock; processes: lockf, which (unlike flock) a forked
+    # child does not inherit, so a fork while this is held cannot wedge it
+    with _append_lock, open(tdir / LOCK_NAME, "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        meta = _read_meta(tdir) or _new_meta(stations, variables or STATION_VARS)
+        if meta["digest"] != stations.digest():
+            raise RuntimeError(f"Station list changed since {tdir} was built; run 'stations.py rebuild'")
+        if meta["files"].get(rel) == stamp:
+            return 0
+
+        if path.suffix == ".gz":
+            with tempfile.NamedTemporaryFile(suffix=".nc") as tf:
+                with gzip.open(path, "rb") as src:
+                    shutil.copyfileobj(src, tf)
+                tf.flush()
+                valid, values = extract_window(open_classic(Path(tf.name)), stations,
+                                               root / TABLE_DIR_NAME, meta["variables"])
+        else:
+            valid, values = extract_window(open_classic(path), stations,
+                                           root / TABLE_DIR_NAME, meta["variables"])
+
+        columns: Dict[str, np.ndarray] = {
+            "run_time": np.full(len(valid), _run_epoch(root, nc_path), dtype=np.int64),
+            "valid_time": valid.astype(np.int64),
+        }
+        columns.update(values)
+        _append_columns(tdir, meta, columns)
+
+        meta["nrows"] = int(meta["nrows"]) + len(valid)
+        meta["files"][rel] = stamp
+        _write_meta(tdir, meta)
+    return len(valid)
+
+
+class StationTable:
+    """Read side of one profile's table; cheap to open, columns are memmapped."""
+
+    def __init__(self, tdir: Path) -> None:
+        meta = _read_meta(tdir)
+        if meta is None:
+            raise FileNotFoundError(f"No station table in {tdir}")
+        self.dir = tdir
+        self.meta = meta
+        self.nrows = int(meta["nrows"])
+        self.stations: List[str] = list(meta["stations"])
+        self.variables: List[str] = list(meta["variables"])
+        self._pos = {sid: k for k, sid in enumerate(self.stations)}
+
+    def __len__(self) -> int:
+        return self.nrows
+
+    def column(self, name: str) -> np.ndarray:
+        if self.nrows == 0:
+            return np.empty((0,) if name in TIME_COLUMNS else (0, len(self.stations)),
+                            dtype=np.int64 if name in TIME_COLUMNS else np.float32)
+        if name in TIME_COLUMNS:
+            return np.memmap(_column_path(self.dir, name), dtype=np.int64, mode="r", shape=(self.nrows,))
+        return np.memmap(_column_path(self.dir, name), dtype=np.float32, mode="r",
+                         shape=(self.nrows, len(self.stations)))
+
+    def history(self, station: str, variables: Optional[List[str]] = None,
+                latest: bool = True) -> Dict[str, np.ndarray]:
+        """
+        Time series of one station, sorted by valid time.
+        latest=True  -> one value per valid time, from the newest run
+        latest=False -> every (run, valid time) pair
+        A window ingested again (e.g. after a top-up) supersedes its earlier rows.
+        """
+        k = self._pos[station]
+        run = np.asarray(self.column("run_time"))
+        valid = np.asarray(self.column("valid_time"))
+        order = np.lexsort((np.arange(self.nrows), run, valid))
+        r, v = run[order], valid[order]
+        # last appended row per (valid, run) ...
+        keep = np.ones(len(order), dtype=bool)
+        keep[:-1] = (v[1:] != v[:-1]) | (r[1:] != r[:-1])
+        if latest:
+            # ... and of those the newest run per valid time
+            keep[:-1] &= v[1:] != v[:-1]
+        rows = order[keep]
+        out = {
+            "run_time": run[rows].astype("datetime64[s]"),
+            "valid_time": valid[rows].astype("datetime64[s]"),
+        }
+        for var in variables or self.variables:
+            out[var] = np.asarray(self.column(var)[rows, k])
+        return out
+
+
+def open_table(root: Path, profile: str) -> StationTable:
+    return StationTable(table_dir(root, profile))
+
+
+# ==========================================
+# Rebuild / CLI
+# ============================================================
+def rebuild(root: Path, logger: logging.Logger) -> int:
+    """Drop every table and re-extract all window files (.nc, or .nc.gz if no .nc)."""
+    stations = load_stations(root / STATIONS_CSV_NAME)
+    shutil.rmtree(root / TABLE_DIR_NAME, ignore_errors=True)
+    files = [p for p in root.rglob("*.nc") if parse_window_path(root, p) is not None]
+    files += [p for p in root.rglob("*.nc.gz")
+              if not p.with_suffix("").exists() and parse_window_path(root, p.with_suffix("")) is not None]
+    logger.info(f"Extracting {len(stations)} stations from {len(files)} windows under {root}")
+    failed = 0
+    for p in sorted(files, key=lambda p: str(p.relative_to(root))):
+        try:
+            append_window(root, p, stations)
+        except Exception as e:
+            failed += 1
+            logger.error(f"FAILED {p.relative_to(root)}: {e}")
+    return 2 if failed else 0
+
+
+def print_history(root: Path, profile: str, station: str, latest: bool) -> int:
+    table = open_table(root, profile)
+    h = table.history(station, latest=latest)
+    w = csv.writer(sys.stdout)
+    w.writerow(["run_time", "valid_time"] + table.variables)
+    for i in range(len(h["valid_time"])):
+        w.writerow([h["run_time"][i], h["valid_time"][i]] + [f"{h[v][i]:.6g}" for v in table.variables])
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    if args and args[0] == "rebuild" and len(args) <= 2:
+        return rebuild(Path(args[1]) if len(args) > 1 else DOWNLOAD_ROOT, logging.getLogger("cams_mars"))
+    if len(args) >= 3 and args[0] == "query":
+        return print_history(DOWNLOAD_ROOT, args[1], args[2], latest="--all" not in args[3:])
+    print("usage: stations.py rebuild [ROOT] | query PROFILE STATION [--all]", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+# %%
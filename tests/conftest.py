@@ -0,0 +1,14 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+SAMPLE = REPO / "data/EUROPE/icki/FC/SFC/20260110/00_00_00/10_01_2026-10_01_2026.nc"
+
+
+@pytest.fixture
+def sample() -> Path:
+    return SAMPLE
@@ -0,0 +1,32 @@
+from availability import parse_listed_steps
+
+TREE = """\
+class     = rd
+type      = fc
+expver    = icki
+   date      = 2026-10-19
+      time      = 00:00:00
+         step      = 0/3/6
+            param     = 207.210/209.210
+         step      = 9
+            param     = 207.210
+"""
+
+TABLE = """\
+class type stream expver date     time step param
+rd    fc   oper   icki   20261019 0000 0    207.210
+rd    fc   oper   icki   20261019 0000 0    209.210
+rd    fc   oper   icki   20261019 0000 3    207.210
+"""
+
+
+def test_tree_listing():
+    assert parse_listed_steps(TREE) == {0: 2, 3: 2, 6: 2, 9: 1}
+
+
+def test_table_listing():
+    assert parse_listed_steps(TABLE) == {0: 2, 3: 1}
+
+
+def test_unreadable_listing():
+    assert parse_listed_steps("number_of_fields=16;\n") is None
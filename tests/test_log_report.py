@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+import pytest
+
+from log_report import KEEP_DAY_INDICES, P2Quantile, build_report, error_class, render, window_key
+
+
+@pytest.mark.parametrize("p", [0.5, 0.9, 0.95])
+@pytest.mark.parametrize("dist", ["uniform", "lognormal"])
+def test_p2_close_to_percentile(p, dist):
+    rng = np.random.default_rng(7)
+    xs = rng.uniform(0, 100, 5000) if dist == "uniform" else rng.lognormal(4, 0.8, 5000)
+    est = P2Quantile(p)
+    for x in xs:
+        est.add(float(x))
+    exact = np.percentile(xs, p * 100)
+    spread = np.percentile(xs, 99) - np.percentile(xs, 1)
+    assert abs(est.value() - exact) < 0.02 * spread
+
+
+def test_p2_exact_for_few_samples():
+    est = P2Quantile(0.5)
+    for x in (5.0, 1.0, 3.0):
+        est.add(x)
+    assert est.value() == 3.0
+
+
+LOG = """\
+2025-12-17 15:09:47,000 | INFO | Script start (UTC): 2025-12-17T13:09:47
+2025-12-17 15:09:48,000 | INFO | Skip existing: 17_12_2025-17_12_2025.nc
+2025-12-17 15:09:48,000 | INFO | Downloading -> 17_12_2025-19_12_2025.nc
+2025-12-17 15:10:48,000 | INFO | Done: 17_12_2025-19_12_2025.nc | 12.00 MB | 60.0 s
+2025-12-17 15:10:48,000 | INFO | Downloading -> 17_12_2025-17_12_2025.nc
+2025-12-17 15:10:50,000 | ERROR | FAILED day_idx=4 (17_12_2025): ERROR 100 (MARS_EXPVER)
+2025-12-17 15:10:51,000 | INFO | Elapsed: 0:01:04
+2025-12-17 16:09:47,000 | INFO | Script start (UTC): 2025-12-17T14:09:47
+2025-12-17 16:09:48,000 | INFO | Skip existing: 17_12_2025-17_12_2025.nc
+2025-12-17 16:09:49,000 | INFO | Elapsed: 0:00:02
+2025-12-17 17:09:47,000 | INFO | Script start (UTC): 2025-12-17T15:09:47
+2025-12-17 17:09:48,000 | INFO | Downloading -> 17_12_2025-17_12_2025.nc
+2025-12-17 17:40:00,000 | ERROR | FAILED day_idx=0 (17_12_2025): mars request timed out
+2025-12-17 18:09:47,000 | INFO | Script start (UTC): 2025-12-17T16:09:47
+2025-12-17 18:09:48,000 | INFO | Downloading -> 17_12_2025-17_12_2025.nc
+2025-12-17 18:09:50,000 | ERROR | FAILED day_idx=0 (17_12_2025): output too small (10 bytes)
+2025-12-17 18:09:51,000 | INFO | Elapsed: 0:00:04
+"""
+
+
+@pytest.fixture
+def far_zone(monkeypatch):
+    # the parser must not depend on the zone of the host running the report
+    monkeypatch.setenv("TZ", "Asia/Tokyo")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_report_over_log(tmp_path, far_zone):
+    log = tmp_path / "CAMS_mars_fc.log"
+    log.write_text(LOG)
+    r = build_report([log])
+
+    assert (r.runs, r.noop_runs, r.incomplete_runs) == (3, 1, 1)
+    assert r.attempts == 4
+    assert r.failures_by_class == {"MARS_EXPVER": 1, "TIMEOUT": 1, "TOO_SMALL": 1}
+    # the label spans two days; the fallback slot does not matter for it
+    assert set(r.latency_by_window) == {"day2"}
+    assert r.latency_by_window["day2"].count == 1
+    # host is UTC+2 and the start stamp is naive UTC: 15:09:48 local -> 13h UTC
+    assert set(r.latency_by_hour) == {13}
+
+    text = render(r)
+    assert "Runs: 3 completed | 1 no-op | 1 incomplete" in text
+    assert "Failures: 3/4 attempts (75.0%)" in text
+    assert "day2" in text
+
+
+def test_window_key_and_error_class():
+    assert window_key("x_D3.nc", 0) == "D3"
+    assert window_key("FAILED day_idx=4", 0) == "day4"
+    assert window_key("17_12_2025-17_12_2025.nc", 1) == f"day{KEEP_DAY_INDICES[1]}"
+    assert error_class("ERROR 100 (MARS_EXPVER)") == "MARS_EXPVER"
+    assert error_class("connection timeout") == "TIMEOUT"
+    assert error_class("something else") == "OTHER"
@@ -0,0 +1,109 @@
+import logging
+import shutil
+import threading
+
+from pipeline import Item, Pipeline, Stage
+from scheduler import FRESH, REPAIR, Job, JobQueue
+from stations import append_window, load_stations, open_table
+from topup import missing_steps
+
+RUN = "EUROPE/icki/FC/SFC/20260110/00_00_00"
+LOG = logging.getLogger("test_pipeline")
+
+
+def _tree(sample, tmp_path):
+    run_dir = tmp_path / RUN
+    run_dir.mkdir(parents=True)
+    for src in sorted(sample.parent.glob("*.nc")):
+        shutil.copy(src, run_dir / src.name)
+    (tmp_path / "stations.csv").write_text("id,lat,lon\nATH,37.98,23.73\nPAR,48.85,2.35\n")
+    return sorted(run_dir.glob("*.nc"))
+
+
+def _run(pipe, items, timeout=120.0):
+    done = threading.Event()
+
+    def go():
+        for it in items:
+            pipe.submit(it)
+        pipe.drain()
+        done.set()
+
+    threading.Thread(target=go, daemon=True).start()
+    return done.wait(timeout)
+
+
+def test_extract_alongside_process_stage_does_not_deadlock(sample, tmp_path):
+    # extract holds the station table lock in a thread while the process
+    # pool starts its workers; a forked worker would keep that lock forever
+    files = _tree(sample, tmp_path)
+    stations = load_stations(tmp_path / "stations.csv")
+    stages = [Stage("extract", lambda item: append_window(tmp_path, item.path, stations)),
+              Stage("probe", missing_steps, in_process=True)]
+    for _ in range(3):
+        pipe = Pipeline(stages, LOG, workers=2, process_workers=2)
+        assert _run(pipe, [Item(p) for p in files]), "pipeline hung"
+        assert pipe.close() == []
+    assert len(open_table(tmp_path, "EUROPE/icki/FC/SFC")) == 8 * len(files)
+
+
+def test_submit_blocks_when_pipeline_is_full(tmp_path):
+    gate = threading.Event()
+    pipe = Pipeline([Stage("slow", lambda item: gate.wait(30))], LOG, workers=2, max_pending=1)
+    pipe.submit(Item(tmp_path / "a.nc"))
+    second = threading.Thread(target=pipe.submit, args=(Item(tmp_path / "b.nc"),), daemon=True)
+    second.start()
+    second.join(0.3)
+    assert second.is_alive(), "submit did not wait for a free slot"
+    gate.set()
+    second.join(30)
+    assert not second.is_alive()
+    pipe.drain()
+    assert pipe.close() == []
+
+
+def test_required_stage_failure_stops_the_file(tmp_path):
+    seen = []
+
+    def verify(item):
+        if item.name == "bad.nc":
+            raise ValueError("too small")
+
+    stages = [Stage("verify", verify, required=True),
+              Stage("extract", lambda item: seen.append(item.name))]
+    pipe = Pipeline(stages, LOG)
+    assert _run(pipe, [Item(tmp_path / "good.nc"), Item(tmp_path / "bad.nc")])
+    failed = pipe.take_failed()
+    assert [(it.name, it.failed_stage, it.error) for it in failed] == [("bad.nc", "verify", "too small")]
+    assert seen == ["good.nc"]
+    assert pipe.take_failed() == []
+    assert pipe.close() == []
+
+
+def test_optional_stage_failure_carries_on(tmp_path):
+    seen = []
+
+    def extract(item):
+        raise OSError("disk full")
+
+    stages = [Stage("extract", extract), Stage("index", lambda item: seen.append(item.name))]
+    pipe = Pipeline(stages, LOG)
+    item = Item(tmp_path / "a.nc")
+    assert _run(pipe, [item])
+    assert seen == ["a.nc"]
+    assert item.stage_errors == {"extract": "disk full"}
+    assert pipe.close() == []
+
+
+def test_verify_failure_is_requeued_as_repair(tmp_path):
+    def verify(item):
+        raise ValueError("not valid")
+
+    queue = JobQueue()
+    job = Job("20260110", 0, FRESH)
+    pipe = Pipeline([Stage("verify", verify, required=True)], LOG)
+    assert _run(pipe, [Item(tmp_path / "a.nc", job=job)])
+    for item in pipe.close():
+        assert queue.retry(item.meta["job"], max_attempts=1)
+    repair = queue.pop()
+    assert (repair.klass, repair.attempt) == (REPAIR, 1)
@@ -0,0 +1,128 @@
+import datetime as dt
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+import pytest
+
+import retention
+from archive_index import SUMMARY_SUFFIX, open_index, register, retired_windows
+from publisher import FEED_NAME
+from retention import Retention
+
+PROFILE = "EUROPE/icki/FC/SFC"
+TODAY = dt.date(2026, 10, 19)
+LOG = logging.getLogger("test_retention")
+
+
+def _window(root, sample, run_date, day, tier="full", summary=False):
+    """One window of PROFILE on disk and in the index, old enough to have settled."""
+    init = dt.datetime.strptime(run_date, "%Y%m%d")
+    label = f"{init:%d_%m_%Y}-{init + dt.timedelta(days=day):%d_%m_%Y}"
+    nc = root / PROFILE / run_date / "00_00_00" / f"{label}.nc"
+    nc.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy(sample, nc)
+    if summary:
+        nc.with_name(nc.stem + SUMMARY_SUFFIX).write_bytes(b"summary")
+    if tier == "compressed":
+        gz = nc.with_name(nc.name + ".gz")
+        with open(nc, "rb") as src, gzip.open(gz, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        nc.unlink()
+    old = time.time() - 2 * retention.SETTLE_SECONDS
+    for p in nc.parent.iterdir():
+        os.utime(p, (old, old))
+    return nc
+
+
+def _tiers(conn):
+    return {r["path"].split("/")[-3] + "/" + r["path"].split("/")[-1]: r["tier"]
+            for r in conn.execute("SELECT path, tier FROM files")}
+
+
+@pytest.fixture
+def archive(tmp_path, sample):
+    conn = open_index(tmp_path)
+
+    def add(run_date, day, **kw):
+        nc = _window(tmp_path, sample, run_date, day, **kw)
+        path = nc if nc.exists() else nc.with_name(nc.name + ".gz")
+        assert register(conn, tmp_path, path, tier=kw.get("tier", "full"))
+        return nc
+
+    yield tmp_path, conn, add
+    conn.close()
+
+
+def _retention(root, conn):
+    r = Retention(root, conn, LOG)
+    r.today = TODAY
+    return r
+
+
+def test_age_rules(archive):
+    root, conn, add = archive
+    fresh = add("20261015", 0)
+    month = add("20260901", 0)
+    year = add("20250901", 0, summary=True)
+    year_bare = add("20250902", 0)
+
+    _retention(root, conn).apply_age_rules()
+
+    assert fresh.exists()
+    assert not month.exists() and month.with_name(month.name + ".gz").exists()
+    assert [p.name for p in year.parent.iterdir()] == [year.stem + SUMMARY_SUFFIX]
+    # no summary to fall back on: compressed rather than dropped
+    assert year_bare.with_name(year_bare.name + ".gz").exists()
+    assert _tiers(conn) == {
+        "20261015/15_10_2026-15_10_2026.nc": "full",
+        "20260901/01_09_2026-01_09_2026.nc": "compressed",
+        "20250901/01_09_2025-01_09_2025.nc": "summary",
+        "20250902/02_09_2025-02_09_2025.nc": "compressed",
+    }
+    assert set(retired_windows(root, PROFILE).values()) == {"compressed", "summary"}
+
+    feed = [json.loads(line) for line in (root / FEED_NAME).read_text().splitlines()]
+    assert {(e["path"].split("/")[-1], e.get("deleted", False)) for e in feed} == {
+        ("01_09_2026-01_09_2026.nc.gz", False), ("01_09_2026-01_09_2026.nc", True),
+        ("01_09_2025-01_09_2025.nc", True),
+        ("02_09_2025-02_09_2025.nc.gz", False), ("02_09_2025-02_09_2025.nc", True),
+    }
+
+
+def test_only_the_freshest_forecast_per_valid_date_is_kept(archive):
+    root, conn, add = archive
+    # valid 2026-06-01 from three runs; the newest run keeps its data
+    add("20260530", 2, summary=True)
+    add("20260531", 1, summary=True)
+    add("20260601", 0, summary=True)
+
+    _retention(root, conn).apply_age_rules()
+
+    assert _tiers(conn) == {
+        "20260530/30_05_2026-01_06_2026.nc": "summary",
+        "20260531/31_05_2026-01_06_2026.nc": "summary",
+        "20260601/01_06_2026-01_06_2026.nc": "compressed",
+    }
+
+
+def test_budget_pushes_oldest_one_tier(archive, caplog):
+    root, conn, add = archive
+    add("20260101", 0, tier="compressed", summary=True)
+    bare = add("20260102", 0, tier="compressed")
+    add("20261015", 0)   # younger than MIN_KEEP_DAYS
+
+    with caplog.at_level(logging.INFO, logger=LOG.name):
+        _retention(root, conn).enforce_budget(0)
+
+    assert _tiers(conn) == {
+        "20260101/01_01_2026-01_01_2026.nc": "summary",
+        "20260102/02_01_2026-02_01_2026.nc": "deleted",
+        "20261015/15_10_2026-15_10_2026.nc": "full",
+    }
+    assert list(bare.parent.iterdir()) == []
+    assert "no summary kept, deleted to meet the disk budget" in caplog.text
+    assert "Still over budget" in caplog.text
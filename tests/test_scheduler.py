@@ -0,0 +1,43 @@
+from scheduler import BACKFILL, FRESH, REPAIR, Job, JobQueue
+
+
+def test_fresh_first_newest_run_then_day():
+    q = JobQueue()
+    q.push(Job("20260110", 0, BACKFILL))
+    q.push(Job("20260111", 4, FRESH))
+    q.push(Job("20260111", 0, FRESH))
+    assert [(j.run_date, j.day_idx) for j in (q.pop(), q.pop(), q.pop())] == [
+        ("20260111", 0), ("20260111", 4), ("20260110", 0)]
+    assert q.pop() is None
+
+
+def test_starved_class_is_served():
+    q = JobQueue(starvation_limit=3)
+    q.push(Job("20260101", 0, REPAIR))
+    for day in range(10):
+        q.push(Job("20260110", day, FRESH))
+    classes = [q.pop().klass for _ in range(11)]
+    # served on the pop after it waited starvation_limit pops, not last
+    assert classes.index(REPAIR) == 3
+    assert len(q) == 0
+
+
+def test_starvation_clock_starts_when_class_gets_work():
+    q = JobQueue(starvation_limit=2)
+    for day in range(5):
+        q.push(Job("20260110", day, FRESH))
+    q.pop()
+    q.pop()
+    q.pop()
+    q.push(Job("20260101", 0, BACKFILL))
+    assert [q.pop().klass for _ in range(3)] == [FRESH, FRESH, BACKFILL]
+
+
+def test_retry_requeues_as_repair_until_attempts_run_out():
+    q = JobQueue()
+    job = Job("20260110", 2, FRESH)
+    assert q.retry(job, max_attempts=1)
+    repair = q.pop()
+    assert (repair.run_date, repair.day_idx, repair.klass, repair.attempt) == ("20260110", 2, REPAIR, 1)
+    assert not q.retry(repair, max_attempts=1)
+    assert len(q) == 0
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from nc_classic import copy_header_vars, open_classic, pack, write_classic
+from topup import HEADER_PAD, PARTIAL_ATTR, merge_steps, missing_steps
+
+STEPS = [0, 3, 6, 9, 12, 15, 18, 21]
+
+
+def _split(sample, path, records, missing, rescale=None):
+    """Write records[...] of the sample as its own file; `rescale` -> (factor, own packing)."""
+    nc = open_classic(sample)
+    variables = []
+    for name, vdims, attrs in copy_header_vars(nc):
+        v = nc[name]
+        if not v.info.is_record:
+            variables.append((name, vdims, np.asarray(v.raw), attrs))
+            continue
+        data = np.asarray(v.raw[records])
+        if rescale is not None and "scale_factor" in attrs:
+            values = v[records].astype(np.float64) * rescale
+            lo, hi = np.nanmin(values), np.nanmax(values)
+            attrs = dict(attrs, add_offset=np.float64((hi + lo) / 2),
+                         scale_factor=np.float64((hi - lo) / 65532))
+            data = pack(values, attrs, v.info.dtype)
+        variables.append((name, vdims, data, attrs))
+    attrs = dict(nc.attrs)
+    if missing:
+        attrs[PARTIAL_ATTR] = "/".join(str(s) for s in missing)
+    write_classic(path, nc.header.dims, attrs, variables, header_pad=HEADER_PAD if missing else 0)
+
+
+def test_merge_same_packing_appends(sample, tmp_path):
+    win, piece = tmp_path / "w.nc", tmp_path / "w.nc.topup"
+    _split(sample, win, slice(0, 5), STEPS[5:])
+    _split(sample, piece, slice(5, 8), [])
+    assert missing_steps(win) == STEPS[5:]
+    size = win.stat().st_size
+
+    assert merge_steps(win, piece, STEPS[5:]) == []
+    merged, ref = open_classic(win), open_classic(sample)
+    assert merged.header.numrecs == 8
+    assert PARTIAL_ATTR not in merged.attrs
+    # appended in place: the header still fits its padding
+    assert win.stat().st_size == size + 3 * merged.header.recsize
+    for name in ref.variables:
+        assert np.array_equal(merged[name].raw, ref[name].raw), name
+
+
+def test_merge_other_packing_rewrites(sample, tmp_path):
+    win, piece = tmp_path / "w.nc", tmp_path / "w.nc.topup"
+    _split(sample, win, slice(0, 4), STEPS[4:])
+    # later steps twice as large: outside the window's int16 range
+    _split(sample, piece, slice(4, 6), [], rescale=2.0)
+
+    assert merge_steps(win, piece, STEPS[4:6]) == STEPS[6:]
+    merged, ref = open_classic(win), open_classic(sample)
+    assert merged.header.numrecs == 6
+    assert missing_steps(win) == STEPS[6:]
+    for name in ("aod550", "duaod550"):
+        expect = np.concatenate([ref[name][0:4], ref[name][4:6] * 2.0])
+        quantum = float(merged[name].attrs["scale_factor"])
+        np.testing.assert_allclose(merged[name][...], expect, atol=1.5 * quantum, rtol=1e-6)
+    assert np.array_equal(merged["time"].raw, ref["time"].raw[:6])
+
+
+def test_merge_rejects_earlier_steps(sample, tmp_path):
+    win, piece = tmp_path / "w.nc", tmp_path / "w.nc.topup"
+    _split(sample, win, slice(2, 4), STEPS[4:])
+    _split(sample, piece, slice(0, 2), [])
+    with pytest.raises(ValueError):
+        merge_steps(win, piece, STEPS[4:6])
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+import collections
+import fcntl
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Deque, Optional, Tuple
+
+# ============================================================
+# Adaptive MARS concurrency (AIMD) and a site-wide bandwidth cap
+# ============================================================
+# Every request reports how long it sat in the ECMWF queue and how fast its
+# result was transferred (RequestTimer hooks the ecmwfapi log messages
+# "Request is active" / "Transfering ..."). AIMDController turns that into
+# the number of requests allowed in flight:
+#   + INCREASE / limit per clean request   (about +1 per round of requests)
+#   * DECREASE on congestion, at most once per round:
+#       - the request failed
+#       - it queued at ECMWF longer than QUEUE_BACKOFF_S (we are over our share)
+#       - its transfer rate fell below RATE_DROP x the best of the last
+#         RATE_MEMORY transfers (the site link is saturated)
+# The limit stays within [MIN_INFLIGHT, MAX_INFLIGHT]; the ECMWF Web API runs
+# at most two requests per user at a time, more only queue there.
+#
+# TokenBucket caps the average download rate. With a state file it is shared
+# (flock) by every process on the host using the same DOWNLOAD_ROOT, so the
+# sfc and model-level scripts draw from one budget. Transfers are charged
+# when they finish and a new request only starts while the bucket is not in
+# debt, so single transfers may burst but the average stays under the cap.
+
+MIN_INFLIGHT = 1
+MAX_INFLIGHT = 2
+INCREASE = 1.0
+DECREASE = 0.5
+QUEUE_BACKOFF_S = 600.0
+RATE_DROP = 0.5
+RATE_MEMORY = 20
+
+BUCKET_NAME = ".bandwidth_bucket.json"
+BUCKET_BURST_S = 30.0   # bucket depth, in seconds of the capped rate
+
+
+def _print_with_timestamp(msg: str) -> None:
+    # what ecmwfapi prints by default
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} {msg}")
+
+
+class Sample:
+    def __init__(self, nbytes: int, queue_s: float, transfer_s: float, ok: bool, started: float) -> None:
+        self.nbytes = nbytes
+        self.queue_s = queue_s
+        self.transfer_s = transfer_s
+        self.ok = ok
+        self.started = started
+
+    @property
+    def rate(self) -> float:
+        return self.nbytes / self.transfer_s if self.transfer_s > 0 else 0.0
+
+
+class RequestTimer:
+    """Pass `timer.log` as ECMWFService(log=...); one timer per thread/server."""
+
+    def __init__(self, forward: Callable[[str], None] = _print_with_timestamp) -> None:
+        self.forward = forward
+        self.t_start = self.t_active = self.t_transfer = 0.0
+
+    def log(self, msg: str) -> None:
+        now = time.time()
+        if not self.t_active and msg.startswith(("Request is active", "Request is complete")):
+            self.t_active = now
+        elif not self.t_transfer and msg.startswith("Transfering"):
+            self.t_transfer = now
+            self.t_active = self.t_active or now
+        self.forward(msg)
+
+    def start(self) -> float:
+        self.t_start = time.time()
+        self.t_active = self.t_transfer = 0.0
+        return self.t_start
+
+    def finish(self, nbytes: int, ok: bool = True) -> Sample:
+        end = time.time()
+        active = self.t_active or self.t_start
+        transfer = self.t_transfer or active
+        return Sample(nbytes, active - self.t_start, end - transfer, ok, self.t_start)
+
+
+class TokenBucket:
+    def __init__(self, rate_bps: float, burst_s: float = BUCKET_BURST_S,
+                 state_path: Optional[Path] = None) -> None:
+        self.rate = rate_bps
+        self.burst = rate_bps * burst_s
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.ts = time.time()
+
+    def _update(self, delta: float) -> float:
+        with self.lock:
+            if self.state_path is None:
+                self.tokens, self.ts = self._refill(self.tokens, self.ts, delta)
+                return self.tokens
+            with open(self.state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    raw = f.read()
+                    state = json.loads(raw) if raw.strip() else {"tokens": self.burst, "ts": time.time()}
+                    tokens, ts = self._refill(float(state["tokens"]), float(state["ts"]), delta)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({"tokens": tokens, "ts": ts}))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            return tokens
+
+    def _refill(self, tokens: float, ts: float, delta: float) -> Tuple[float, float]:
+        now = time.time()
+        tokens = min(self.burst, tokens + max(0.0, now - ts) * self.rate)
+        return tokens + delta, now
+
+    def wait(self) -> None:
+        """Block while the bucket is in debt."""
+        while True:
+            tokens = self._update(0.0)
+            if tokens >= 0:
+                return
+            time.sleep(min(-tokens / self.rate, 5.0))
+
+    def charge(self, nbytes: int) -> None:
+        self._update(-float(nbytes))
+
+
+class AIMDController:
+    def __init__(self, logger: logging.Logger, min_inflight: int = MIN_INFLIGHT,
+                 max_inflight: int = MAX_INFLIGHT, bucket: Optional[TokenBucket] = None) -> None:
+        self.logger = logger
+        self.min = min_inflight
+        self.max = max_inflight
+        self.bucket = bucket
+        self.limit = float(min_inflight)
+        self.inflight = 0
+        self.cond = threading.Condition()
+        self.rates: Deque[float] = collections.deque(maxlen=RATE_MEMORY)
+        self.last_decrease = 0.0
+
+    def acquire(self) -> None:
+        """Block until another request may start."""
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+        if self.bucket is not None:
+            self.bucket.wait()
+
+    def cancel(self) -> None:
+        """Give back a slot that was not used for a request."""
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify()
+
+    def release(self, s: Sample) -> None:
+        if self.bucket is not None and s.nbytes:
+            self.bucket.charge(s.nbytes)
+        with self.cond:
+            self.inflight -= 1
+            before = int(self.limit)
+            reason = self._congestion(s)
+            if reason is not None:
+                # one decrease per round: ignore requests started before the last one
+                if s.started >= self.last_decrease:
+                    self.limit = max(float(self.min), self.limit * DECREASE)
+                    self.last_decrease = time.time()
+            else:
+                self.limit = min(float(self.max), self.limit + INCREASE / self.limit)
+            if s.ok and s.rate > 0:
+                self.rates.append(s.rate)
+            if int(self.limit) != before:
+                why = f" ({reason})" if reason else ""
+                self.logger.info(f"Concurrency {before} -> {int(self.limit)}{why} | "
+                                 f"queue {s.queue_s:.0f} s | {s.rate / 1048576:.2f} MB/s")
+            self.cond.notify_all()
+
+    def _congestion(self, s: Sample) -> Optional[str]:
+        if not s.ok:
+            return "request failed"
+        if s.queue_s > QUEUE_BACKOFF_S:
+            return "queued at ECMWF"
+        if self.rates and s.rate < RATE_DROP * max(self.rates):
+            return "transfer rate dropped"
+        return None
+# %%
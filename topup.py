@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#%%
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from nc_classic import (AttrValue, ClassicFile, append_records, copy_header_vars, open_classic, pack,
+                        read_header, write_classic)
+
+# ============================================================
+# Partial windows and step top-up
+# ============================================================
+# MARS publishes a forecast step by step. When only the first steps of a
+# window are archived, auto_download.py fetches those (the longest available
+# prefix of steps_as_list(), so later steps can only ever be appended in time
+# order) and writes the window with a global attribute
+#   missing_steps = "15/18/21"
+# which the archive index mirrors (files.missing_steps). A later run asks
+# MARS for just the missing steps, into "<label>.nc.topup", and merge_steps()
+# appends their records to the window in place and shrinks / drops the
+# attribute. Partial files are written with HEADER_PAD spare header bytes so
+# that the attribute can be rewritten without moving any data.
+# If the new values do not fit the window's int16 packing (scale_factor /
+# add_offset were chosen by MARS for the first steps only), the window is
+# rewritten once with a packing covering all steps instead.
+
+PARTIAL_ATTR = "missing_steps"
+TOPUP_SUFFIX = ".topup"
+HEADER_PAD = 1024
+
+
+def parse_steps(spec: Optional[AttrValue]) -> List[int]:
+    """'0/3/6' -> [0, 3, 6]; empty/None -> []."""
+    if spec is None:
+        return []
+    return [int(s) for s in str(spec).split("/") if s.strip()]
+
+
+def format_steps(steps: Sequence[int]) -> str:
+    return "/".join(str(s) for s in steps)
+
+
+def missing_steps(path: Path) -> List[int]:
+    """Steps a window still lacks ([] for complete windows and non-classic files)."""
+    try:
+        return parse_steps(read_header(path).attrs.get(PARTIAL_ATTR))
+    except (ValueError, OSError):
+        return []
+
+
+def available_prefix(avail, req: Dict[str, str], steps: Sequence[int]) -> List[int]:
+    """Leading `steps` that MARS already has (one list request, see Availability.steps_present)."""
+    present = avail.steps_present(dict(req, step=format_steps(steps)))
+    out: List[int] = []
+    for s in steps:
+        if present is None or s not in present:
+            break
+        out.append(s)
+    return out
+
+
+def _with_missing(attrs: Dict[str, AttrValue], missing: Sequence[int]) -> Dict[str, AttrValue]:
+    out = {k: v for k, v in attrs.items() if k != PARTIAL_ATTR}
+    if missing:
+        out[PARTIAL_ATTR] = format_steps(missing)
+    return out
+
+
+def _file_vars(nc: ClassicFile):
+    return [(name, vdims, np.asarray(nc[name].raw), attrs) for name, vdims, attrs in copy_header_vars(nc)]
+
+
+def mark_partial(path: Path, missing: Sequence[int]) -> None:
+    """Rewrite a freshly downloaded window with the missing_steps attribute and header room."""
+    nc = open_classic(path)
+    write_classic(path, nc.header.dims, _with_missing(dict(nc.attrs), missing), _file_vars(nc),
+                  header_pad=HEADER_PAD)
+
+
+def _check_compatible(win: ClassicFile, piece: ClassicFile) -> None:
+    if [d for d in win.header.dims if d[1]] != [d for d in piece.header.dims if d[1]]:
+        raise ValueError("Top-up grid does not match the window")
+    if sorted(win.variables) != sorted(piece.variables):
+        raise ValueError("Top-up variables do not match the window")
+    for name, info in win.variables.items():
+        if not info.is_record and win[name].raw.tobytes() != piece[name].raw.tobytes():
+            raise ValueError(f"Top-up {name} does not match the window")
+    if win["time"].attrs.get("units") != piece["time"].attrs.get("units"):
+        raise ValueError("Top-up time units do not match the window")
+    if win.header.numrecs and piece["time"].raw.min() <= win["time"].raw.max():
+        raise ValueError("Top-up steps must all follow the steps already in the window")
+
+
+def _repack(win: ClassicFile, piece: ClassicFile, name: str) -> Optional[np.ndarray]:
+    """The piece's records in the window's packing, or None if they do not fit it."""
+    w, p = win[name], piece[name]
+    dtype = w.info.dtype
+    if dtype == p.info.dtype and all(w.attrs.get(k) == p.attrs.get(k)
+                                     for k in ("scale_factor", "add_offset", "_FillValue", "missing_value")):
+        return np.asarray(p.raw)
+    values = p[...].astype(np.float64)
+    if dtype.kind in "iu" and "scale_factor" in w.attrs:
+        info = np.iinfo(dtype)
+        q = (values - float(w.attrs.get("add_offset", 0.0))) / float(w.attrs["scale_factor"])
+        q = q[np.isfinite(q)]
+        if q.size and (np.round(q.min()) < info.min + 1 or np.round(q.max()) > info.max):
+            return None
+    return pack(values, w.attrs, dtype)
+
+
+def _rewrite_merged(win: ClassicFile, piece: ClassicFile, path: Path, missing: Sequence[int]) -> None:
+    out = []
+    for name, vdims, attrs in copy_header_vars(win):
+        w = win[name]
+        if not w.info.is_record:
+            out.append((name, vdims, np.asarray(w.raw), attrs))
+            continue
+        if w.info.dtype.kind in "iu" and "scale_factor" in attrs:
+            values = np.concatenate([w[...], piece[name][...]]).astype(np.float64)
+            info = np.iinfo(w.info.dtype)
+            lo, hi = np.nanmin(values), np.nanmax(values)
+            attrs = dict(attrs)
+            attrs["add_offset"] = np.float64((hi + lo) / 2)
+            attrs["scale_factor"] = np.float64((hi - lo) / (2 * (info.max - 1)) if hi > lo else 1.0)
+            data = pack(values, attrs, w.info.dtype)
+        else:
+            data = np.concatenate([np.asarray(w.raw), np.asarray(piece[name].raw).astype(w.info.dtype)])
+        out.append((name, vdims, data, attrs))
+    write_classic(path, win.header.dims, _with_missing(dict(win.attrs), missing), out, header_pad=HEADER_PAD)
+
+
+def merge_steps(path: Path, piece: Path, steps: Sequence[int]) -> List[int]:
+    """
+    Append the records of `piece` (the window's missing `steps`, as downloaded)
+    to the window at `path`. Returns the steps that are still missing.
+    """
+    win = open_classic(path)
+    new = open_classic(piece)
+    _check_compatible(win, new)
+    if new.header.numrecs != len(steps):
+        raise ValueError(f"Top-up holds {new.header.numrecs} steps, expected {len(steps)}")
+    left = [s for s in parse_steps(win.attrs.get(PARTIAL_ATTR)) if s not in set(steps)]
+
+    records: Dict[str, np.ndarray] = {}
+    for name, info in win.variables.items():
+        if info.is_record:
+            packed = _repack(win, new, name)
+            if packed is None:
+                _rewrite_merged(win, new, path, left)
+                return left
+            records[name] = packed
+    append_records(path, records, attrs=_with_missing(dict(win.attrs), left))
+    return left
+# %%